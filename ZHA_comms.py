@@ -2,16 +2,141 @@ from machine import ADC
 import struct
 import xbee
 import time
-from sys import stdout
+import sys
+import gc
 import uio
 import uos
+import ubinascii
+import log
+import energy
+import trace
+import thermostat
+import history
 
 LOG_FILE = "ships_log.log"
 
+PROFILE_HA = 0x0104
+
+OPTIONAL_MODULES = ('maintenance',)  # see TRV.optional
+
+# analogue cluster EngineeringUnits
+UNITS_NONE = 95  # valve position in revolutions from fully open
+UNITS_PERCENT = 98  # valve position as percentage open
+
+# Device description, one entry per endpoint. The ZDO active endpoints and simple descriptor responses and the ZCL
+# dispatcher are all generated from this at import time, so an endpoint or cluster only has to be added here.
+# 'input': advertised server clusters - (cluster, read attributes handler, write attributes handler,
+#          cluster specific command handler), handlers are named as for TRV.call
+# 'unlisted': clusters that are handled but left out of the simple descriptor
+# 'output': advertised client clusters, in the same form as 'input'
+DEVICE = (
+    # endpoint for Tim's radiator valve controller device
+    {'endpoint': 0x55, 'profile': PROFILE_HA, 'device_id': 0x0000, 'version': 0x00,
+     'input': ((0x0000, 'read_basic', None, None),
+               (0x0001, 'read_power_configuration', None, None),
+               (0x0002, 'read_device_temperature', None, None),
+               (0x0006, 'read_on_off', None, 'on_off_command'),
+               (0x000d, 'read_valve_revolutions', 'write_valve_position', None),
+               (0x000f, 'read_awake', None, None),
+               (0x0201, 'read_thermostat', 'write_thermostat', None),
+               (0x0b05, 'maintenance.read_diagnostics', None, None)),
+     # Groups and Scenes keep the membership the 'Z' command acts on, but aren't advertised: group multicasts can't
+     # be acted on (see GROUP_IGNORED), so ZHA mustn't offer the valve for its groups
+     'unlisted': ((0x0004, 'read_groups', None, 'groups_command'),
+                  (0x0005, 'read_scenes', None, 'scenes_command')),
+     'output': ((0x0010, None, None, None),  # binary output (not recognised by Home Assistant)
+                (0x0019, None, None, 'ota_command'))},
+    # endpoint for diagnostics
+    {'endpoint': 0x01, 'profile': PROFILE_HA, 'device_id': 0x0000, 'version': 0x00,
+     'input': ((0x000d, 'maintenance.read_battery_voltage', None, None),),
+     'unlisted': ((0x000f, 'read_awake', None, None),),
+     'output': ()},
+    # endpoint for valve period
+    {'endpoint': 0x02, 'profile': PROFILE_HA, 'device_id': 0x0000, 'version': 0x00,
+     'input': ((0x000d, 'maintenance.read_valve_period', None, None),),
+     'unlisted': ((0x000f, 'read_awake', None, None),),
+     'output': ()},
+    # endpoint for estimated charge used
+    {'endpoint': 0x03, 'profile': PROFILE_HA, 'device_id': 0x0000, 'version': 0x00,
+     'input': ((0x000d, 'maintenance.read_charge_used', None, None),),
+     'unlisted': ((0x000f, 'read_awake', None, None),),
+     'output': ()},
+    # endpoint for the expected time until the valve reaches its target, 0 when it isn't moving
+    {'endpoint': 0x04, 'profile': PROFILE_HA, 'device_id': 0x0000, 'version': 0x00,
+     'input': ((0x000d, 'read_travel_eta', None, None),),
+     'unlisted': ((0x000f, 'read_awake', None, None),),
+     'output': ()},
+)
+
+# Clusters whose group (or broadcast) frames to the valve endpoint are ignored, as they would move the valve: receive()
+# doesn't give the group a frame was addressed to, so a multicast for any group (e.g. a light group's off) would act.
+# Zones of valves are moved with the TRV 'Z' command instead, which carries the group ID.
+GROUP_IGNORED = (0x0005, 0x0006, 0x000d)
+
+# struct format of the ZCL data types that can be written
+ZCL_DATA_TYPES = {0x10: 'B', 0x18: 'B', 0x20: 'B', 0x21: '<H', 0x28: 'b', 0x29: '<h', 0x30: 'B', 0x31: '<H',
+                  0x39: '<f'}
+
+
+def simple_descriptor(description):
+    # endpoint, profile id, device description identifier, version+reserved
+    descriptor = struct.pack('<BHHB', description['endpoint'], description['profile'], description['device_id'],
+                             description['version'])
+    descriptor += struct.pack('B', len(description['input']))  # input cluster count
+    for cluster in description['input']:
+        descriptor += struct.pack('<H', cluster[0])
+    descriptor += struct.pack('B', len(description['output']))  # output cluster count
+    for cluster in description['output']:
+        descriptor += struct.pack('<H', cluster[0])
+    return struct.pack('B', len(descriptor)) + descriptor  # length of simple descriptor first
+
+
+def describe_device(device):
+    endpoints = sorted(description['endpoint'] for description in device)
+    active_endpoints = struct.pack('B', len(endpoints)) + bytes(endpoints)
+    simple_descriptors = {}
+    zcl_handlers = {}
+    for description in device:
+        simple_descriptors[description['endpoint']] = simple_descriptor(description)
+        for cluster in description['input'] + description['unlisted'] + description['output']:
+            zcl_handlers[(description['endpoint'], cluster[0])] = cluster[1:]
+    return active_endpoints, simple_descriptors, zcl_handlers
+
+
+ACTIVE_ENDPOINTS, SIMPLE_DESCRIPTORS, ZCL_HANDLERS = describe_device(DEVICE)
+
+
+def attribute_record(attribute, data_type, fmt, value):
+    # attribute ID (2 bytes), status (1 byte), data type (1 byte), value (variable length)
+    return struct.pack('<HBB' + fmt, attribute, 0x00, data_type, value)
+
+
+def string_record(attribute, string):
+    return attribute_record(attribute, 0x42, 'B', len(string)) + string
+
+
+def analogue_records(description, present_value):
+    return (string_record(0x001c, description)  # Description (variable bytes)
+            + attribute_record(0x0051, 0x10, 'B', 0x00)  # OutOfService (1 byte)
+            + attribute_record(0x0055, 0x39, 'f', present_value)  # PresentValue (4 bytes)
+            + attribute_record(0x006f, 0x18, 'B', 0x00))  # StatusFlags (1 byte)
+
+
+def binary_records(description, present_value):
+    return (string_record(0x001c, description)  # Description (variable bytes)
+            + attribute_record(0x0051, 0x10, 'B', 0x00)  # OutOfService (1 byte)
+            + attribute_record(0x0055, 0x10, 'B', present_value)  # PresentValue (1 byte)
+            + attribute_record(0x006f, 0x18, 'B', 0x00))  # StatusFlags (1 byte)
+
 
 class TRV:
     xbee = xbee
     valve = None
+    thermostat = None
+    ota = None
+    history = None
+    power = None
+    groups = None
     data = [0]
     on_off_attributes = {
         'OnOff': True}
@@ -21,9 +146,33 @@ class TRV:
     address = 0
     voltage_monitor = ADC('D2')
     awake_flag = 1
+    REPORT_INTERVAL = 180000  # milliseconds
+    next_report = 0
+    last_received = 0  # when the last frame was received
+    valve_units = UNITS_NONE  # of the valve's analogue output PresentValue
     connected_to_HA = True
     logger = None
     processing_message = False
+    recent_frames = []  # [key, time received, reply] of recently handled frames, to spot retries
+    DUPLICATE_CACHE_SIZE = 8
+    DUPLICATE_EXPIRY = 10000  # milliseconds a frame is remembered for
+    reply_entry = None  # recent_frames entry waiting for the reply to the frame being handled
+    OPTIONAL_IDLE = 60000  # milliseconds an optional module stays loaded after its last use
+    optional_used = 0
+    keep_optional = False  # set by the full profile, which imports the optional modules at boot
+    boot_heap = (0, 0)  # bytes used by the firmware and free after boot, measured in main.py
+    # After a power cut every valve in a building boots at once, so the boot homing (a current surge), the reports and
+    # the rejoin attempts are spread out by a delay that is different for each device but always the same for a given
+    # device, derived from its EUI64. Spreads are in milliseconds, 0 turns the jitter off.
+    STARTUP_SPREAD = 60000  # boot homing starts up to this long after joining
+    REPORT_SPREAD = 30000  # report intervals vary by up to half of this either side of REPORT_INTERVAL
+    REJOIN_BACKOFF = 10000  # first wait after asking to rejoin, doubling on each attempt up to REJOIN_MAX
+    REJOIN_MAX = 160000
+    REJOIN_SPREAD = 10000  # added to each rejoin wait
+    seed = None  # per device jitter seed, see jitter()
+    reports = 0  # report cycles, so each report interval gets a different jitter
+    rejoin_attempts = 0
+    home_at = None  # when the boot homing is due, it waits in the main loop so frames are handled meanwhile
 
     def initialise(self):
         # creating log file, if it exists, remove it.
@@ -39,28 +188,63 @@ class TRV:
         self.valve.stop_valve()
         self.get_network_address()
         time.sleep(5)  # to allow time for coordinator to send messages
-        self.valve.home_valve()
-        self.report_attributes()
+        startup_delay = self.jitter(self.STARTUP_SPREAD, 0)
+        self.log('homing in %i ms' % startup_delay)
+        self.home_at = time.ticks_add(time.ticks_ms(), startup_delay)
 
     def run(self):
         self.log("trv program running")
-        counter = time.ticks_ms()
+        self.next_report = time.ticks_add(time.ticks_ms(), self.report_interval())
         while True:
             if self.xbee.atcmd("AI") != 0:
-                print('not connected to network')
+                log.warning('comms', 'not connected to network')
                 self.xbee.atcmd("CB", 1)
-                time.sleep_ms(10000)
+                time.sleep_ms(self.rejoin_backoff())
+                self.rejoin_attempts += 1
+            else:
+                self.rejoin_attempts = 0
+            energy.tick()
             self.process_msg()
-            if time.ticks_diff(time.ticks_ms(), counter) > 180000:
-                counter = time.ticks_ms()
+            if (self.home_at is not None) and (time.ticks_diff(time.ticks_ms(), self.home_at) >= 0):
+                self.home_at = None
+                self.valve.home_valve()
+                self.report_attributes()
+            self.thermostat.update()
+            self.valve.update()
+            self.history.update()
+            self.ota.update()
+            if time.ticks_diff(time.ticks_ms(), self.next_report) >= 0:
+                self.next_report = time.ticks_add(time.ticks_ms(), self.report_interval())
                 self.report_attributes()
-            if time.ticks_diff(time.ticks_ms(), counter) // 60 == 1:
-                # print("sleeping for 50 seconds\n")
-                # self.awake_flag = 0
-                self.report_attribute(0x000f, 0x55)
-                # self.xbee.XBee().sleep_now(50000, pin_wake=True)
-                # self.awake_flag = 1
-                # self.report_attributes(0x000f)
+            self.unload_optional()
+            self.power.update()
+
+    def jitter(self, spread, salt):
+        # 0 to spread - 1, a hash of the device's EUI64 and salt, so devices differ but a device always gets the same
+        # delay for the same salt
+        if spread <= 0:
+            return 0
+        if self.seed is None:
+            seed = 0
+            for command in ('SH', 'SL'):
+                value = self.xbee.atcmd(command)
+                if isinstance(value, bytes):
+                    value = int.from_bytes(value, 'big')
+                seed = (seed * 31 + value) & 0x3fffffff
+            self.seed = seed
+        value = (self.seed ^ (salt * 0x9e3779b1)) & 0x3fffffff
+        # multiply and xor-shift rounds, to spread consecutive addresses and salts apart
+        for _ in range(2):
+            value = ((value ^ (value >> 16)) * 0x45d9f3b) & 0x3fffffff
+        return (value ^ (value >> 16)) % spread
+
+    def report_interval(self):
+        self.reports += 1
+        return self.REPORT_INTERVAL - self.REPORT_SPREAD // 2 + self.jitter(self.REPORT_SPREAD, self.reports)
+
+    def rejoin_backoff(self):
+        backoff = min(self.REJOIN_BACKOFF << min(self.rejoin_attempts, 8), self.REJOIN_MAX)
+        return backoff + self.jitter(self.REJOIN_SPREAD, 0x100 + self.rejoin_attempts)
 
     def log(self, info):
         return self.logger.write("[%04x %08i] %s\n" % (self.address, time.ticks_ms(), info))
@@ -79,30 +263,40 @@ class TRV:
         self.report_attribute(0x0002, 0x55)
         self.report_attribute(0x0006, 0x55)
         self.report_attribute(0x000d, 0x55)
+        self.report_attribute(0x0201, 0x55)
         self.report_attribute(0x000d, 0x01)
         self.report_attribute(0x000d, 0x02)
+        self.report_attribute(0x000d, 0x03)
+        self.report_attribute(0x000d, 0x04)
 
-    def send(self):
+    def send(self, dest=xbee.ADDR_COORDINATOR):
         try:
-            xbee.transmit(xbee.ADDR_COORDINATOR, self.msg['payload'], source_ep=self.msg['source_ep'],
+            xbee.transmit(dest, self.msg['payload'], source_ep=self.msg['source_ep'],
                           dest_ep=self.msg['dest_ep'],
                           cluster=self.msg['cluster'], profile=self.msg['profile'], bcast_radius=0, tx_options=0)
-            self.data = list(self.msg['payload'])
-            if self.msg['dest_ep'] == 0x0000:
-                print('\ntransmit to coordinator [%02x]: %s' % (self.data[0], self.msg['payload']))
-            else:
-                print('\ntransmit to coordinator [%02x]: %s' % (self.data[1], self.msg['payload']))
+            energy.transmit(len(self.msg['payload']))
+            if self.reply_entry is not None:
+                # remember the reply, so it can be sent again if the frame is retried
+                self.reply_entry[2] = (bytes(self.msg['payload']), self.msg['cluster'], self.msg['source_ep'],
+                                       self.msg['dest_ep'], self.msg['profile'], dest)
+                self.reply_entry = None
+            if __debug__:
+                # sequence number is the first byte of a ZDO frame, the second of a ZCL frame
+                log.debug('comms', 'transmit to coordinator [%02x]: %s',
+                          self.msg['payload'][0 if self.msg['dest_ep'] == 0x0000 else 1], self.msg['payload'])
         except OSError:
-            print('OSError - could not send to coordinator')
+            log.error('comms', 'OSError - could not send to coordinator')
 
     def send_broadcast_digi_data(self, string):
         try:
             time.sleep_ms(200)
             xbee.transmit(xbee.ADDR_BROADCAST, string)
+            energy.transmit(len(string))
         except OSError:
-            print('OSError - could not send digi data')
+            log.error('comms', 'OSError - could not send digi data')
 
     def send_for_printing(self, info):
+        self.reply_entry = None
         self.msg['source_ep'] = 0xf0
         self.msg['profile'] = 0x0104
         self.msg['dest_ep'] = 0xf0
@@ -111,9 +305,11 @@ class TRV:
             xbee.transmit(xbee.ADDR_BROADCAST, self.msg['payload'], source_ep=self.msg['source_ep'],
                           dest_ep=self.msg['dest_ep'],
                           cluster=self.msg['cluster'], profile=self.msg['profile'], bcast_radius=0, tx_options=0)
-            print('transmit for printing [%02x]: %s' % (self.data[1], self.msg['payload']))
+            energy.transmit(len(self.msg['payload']))
+            if __debug__:
+                log.debug('comms', 'transmit for printing: %s', self.msg['payload'])
         except OSError:
-            print('OSError - could not send for printing')
+            log.error('comms', 'OSError - could not send for printing')
 
     def reference_voltage(self):
         av = self.xbee.atcmd("AV")
@@ -185,65 +381,43 @@ class TRV:
         received_msg = self.xbee.receive()
         if received_msg is not None:
             self.processing_message = True
+            self.last_received = time.ticks_ms()
+            energy.receive()
+            if trace.recording:
+                trace.frame(received_msg)
             self.msg['cluster'] = received_msg['cluster']
             self.msg['dest_ep'] = received_msg['source_ep']
             self.msg['source_ep'] = received_msg['dest_ep']
             self.msg['profile'] = received_msg['profile']
-            print("\ndata received from %s >> \npayload: %s \ncluster: %04x \nsource ep: %02x \ndestination ep: %02x"
-                  "\nprofile: %04x" % (
-                      ''.join('{:02x}'.format(x).upper() for x in received_msg['sender_eui64']),
-                      received_msg['payload'], received_msg['cluster'],
-                      received_msg['source_ep'], received_msg['dest_ep'], received_msg['profile']))
             self.data = list(received_msg['payload'])
-            if received_msg['dest_ep'] == 0x0000:
-                print('sequence number: %02x' % self.data[0])
-            else:
-                print('sequence number: %02x' % self.data[1])
+            if __debug__:
+                if log.enabled('comms', log.DEBUG):
+                    log.debug('comms', 'data received from %s >> \npayload: %s \ncluster: %04x \nsource ep: %02x '
+                                       '\ndestination ep: %02x \nprofile: %04x',
+                              ubinascii.hexlify(received_msg['sender_eui64']).decode().upper(), received_msg['payload'],
+                              received_msg['cluster'], received_msg['source_ep'], received_msg['dest_ep'],
+                              received_msg['profile'])
+            if self.duplicate_frame(received_msg):
+                return
 
             # ---------------------------------------------------------------------------------------------------------------------
             # ZDO endpoint
             if received_msg['dest_ep'] == 0x0000:
                 # active endpoints request
                 if self.msg['cluster'] == 0x0005:
-                    self.msg['payload'] = bytearray(
-                        '{:c}\x00{:c}{:c}\x03\x01\x02\x55'.format(self.data[0], self.msg['address_low'],
-                                                                  self.msg['address_high']))
+                    # sequence number, status, network address, endpoint count and list (generated from DEVICE)
+                    self.msg['payload'] = struct.pack('<BBH', self.data[0], 0x00, self.address) + ACTIVE_ENDPOINTS
                     self.msg['cluster'] = 0x8005
                     self.send()
                 # simple descriptor request
                 elif self.msg['cluster'] == 0x0004:
-                    if self.data[3] == 0x55:
-                        self.msg['payload'] = bytearray(
-                            '{:c}\x00{:c}{:c}\x16'  # length of simple descriptor (last byte)
-                            '\x55\x04\x01\x00\x00\x00'  # endpoint, profile id, device description identifier, version+reserved  
-                            '\x06'  # input cluster count
-                            '\x00\x00'  # basic
-                            '\x01\x00'  # power configuration
-                            '\x02\x00'  # device temperature configuration
-                            '\x06\x00'  # on/off
-                            '\x0d\x00'  # analogue output
-                            '\x0f\x00'  # binary input
-                            '\x01'  # output cluster count
-                            '\x10\x00'  # binary output (not recognised by Home Assistant)
-                            .format(self.data[0], self.msg['address_low'], self.msg['address_high']))
-                    elif self.data[3] == 0x01:
-                        self.msg['payload'] = bytearray(
-                            '{:c}\x00{:c}{:c}\x08'  # length of simple descriptor (last byte)
-                            '\x01\x04\x01\x00\x00\x00'  # endpoint, profile id, device description identifier, version+reserved  
-                            '\x01'  # input cluster count 
-                            '\x0d\x00'  # analogue input
-                            # '\x0f\x00'  # binary input
-                            '\x00'  # output cluster count
-                            .format(self.data[0], self.msg['address_low'], self.msg['address_high']))
-                    elif self.data[3] == 0x02:
-                        self.msg['payload'] = bytearray(
-                            '{:c}\x00{:c}{:c}\x08'  # length of simple descriptor (last byte)
-                            '\x02\x04\x01\x00\x00\x00'  # endpoint, profile id, device description identifier, version+reserved  
-                            '\x01'  # input cluster count 
-                            '\x0d\x00'  # analogue input
-                            # '\x0f\x00'  # binary input
-                            '\x00'  # output cluster count
-                            .format(self.data[0], self.msg['address_low'], self.msg['address_high']))
+                    descriptor = SIMPLE_DESCRIPTORS.get(self.data[3])
+                    if descriptor is None:
+                        # status 0x83 - not active, descriptor length 0
+                        self.msg['payload'] = struct.pack('<BBHB', self.data[0], 0x83, self.address, 0x00)
+                    else:
+                        # sequence number, status, network address, descriptor length and descriptor (generated from DEVICE)
+                        self.msg['payload'] = struct.pack('<BBH', self.data[0], 0x00, self.address) + descriptor
                     self.msg['cluster'] = 0x8004
                     self.send()
                 # management leave request
@@ -263,387 +437,407 @@ class TRV:
                     self.send()
                 # coordinator's 16bit IEEE address
                 elif self.msg['cluster'] == 0x8001:
-                    print("coordinator's 16 bit IEEE address: %s" % ''.join('{:02x}'.format(x).upper() for x in received_msg['payload'][9:1:-1]))
+                    if __debug__:
+                        log.debug('comms', "coordinator's 16 bit IEEE address: %s",
+                                  ''.join('{:02x}'.format(x).upper() for x in received_msg['payload'][9:1:-1]))
                 else:
-                    print('ZDO cluster %04x not supported' % self.msg['cluster'])
+                    log.warning('comms', 'ZDO cluster %04x not supported', self.msg['cluster'])
+
+            # ---------------------------------------------------------------------------------------------------------------------
+            # group frames that would move the valve are ignored, see GROUP_IGNORED
+            elif received_msg['broadcast'] and (received_msg['dest_ep'] in (0x55, 0xff)) and (
+                    self.msg['cluster'] in GROUP_IGNORED):
+                if __debug__:
+                    log.debug('comms', 'group frame for cluster %04x ignored', self.msg['cluster'])
 
             # ---------------------------------------------------------------------------------------------------------------------
-            # endpoint for Tim's radiator valve controller device
-            elif received_msg['dest_ep'] == 0x55:
-                # 'basic' cluster
-                if self.msg['cluster'] == 0x0000:
-                    # global cluster commands
-                    if self.data[0] & 0b11 == 0b00:
-                        # read attributes '0x00'
-                        if self.data[2] == 0x00:
-                            # read attributes response '0x01' Zigpy asks for attributes 4 (manf name) and 5 (model identifier)
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x01'  # header global/cluster-specific (2 bits) manufacturer specific (1 bit) direction (1 bit [1 = server to client]) disable default response (1 bit [0 = default response returned, e.g. 1 used when response frame is a direct effect of a previously recieved frame])
-                                # attribute ID (2 bytes), status (1 byte), data type (1 byte), value (variable length)
-                                # '\x00\x00\x00\x20\x02'  # zigby stack version: 02
-                                '\x04\x00\x00\x42\x09TW-Design'
-                                '\x05\x00\x00\x42\x08MW-Valve'
-                                # '\x07\x00\x00\x30\x03'  # power source - 03 = battery
-                                .format(self.data[1]))
-                            self.send()
-                        else:
-                            print('general command : %04x not supported' % self.data[2])
-                # 'power configuration' cluster
-                elif self.msg['cluster'] == 0x0001:
-                    # global cluster commands
-                    if self.data[0] & 0b11 == 0b00:
-                        # read attributes '0x00'
-                        if self.data[2] == 0x00:
-                            # read attributes response '0x01'
-                            batt_voltage = bytearray(struct.pack("B", self.battery_voltage()))
-                            batt_percentage_remaining = bytearray(struct.pack("B", self.battery_percentage_remaining()))
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x01'  # header, sequence number, command identifier
-                                # attribute ID (2 bytes), status (1 byte), data type (1 byte), value (variable length)
-                                '\x20\x00\x00\x20'.format(self.data[1])) + batt_voltage + bytearray(
-                                # battery voltage (1 byte - uint8)
-                                '\x21\x00\x00\x20') + batt_percentage_remaining + bytearray(
-                                '\x31\x00\x00\x30\x03')  # battery size: AA
-                            if self.data[3] == 0x21:  # attribute identifier: battery percentage
-                                self.msg['payload'] = bytearray(
-                                    '\x18{:c}\x01'  # header, sequence number, command identifier
-                                    # attribute ID (2 bytes), status (1 byte), data type (1 byte), value (variable length)
-                                    '\x21\x00\x00\x20'.format(self.data[1])) + self.battery_percentage_remaining()
-                            self.send()
-                        # configure reporting '0x06'
-                        elif self.data[2] == 0x06:
-                            # configure reporting response '0x07'
-                            # just responds with success, even though I haven't set up any reporting mechanism!
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x07'  # header, sequence number, command identifier
-                                '\x00'.format(self.data[
-                                                  1]))  # only sending a single ZCL payload byte (0x00) to indicate that all attributes were successfully configured
-                            self.send()
-                        else:
-                            print('general command : %04x not supported' % self.data[2])
-                # 'temperature configuration' cluster
-                elif self.msg['cluster'] == 0x0002:
-                    # global cluster commands
-                    if self.data[0] & 0b11 == 0b00:
-                        # read attributes '0x00'
-                        if self.data[2] == 0x00:
-                            # read attributes response '0x01'
-                            device_temperature = bytearray(struct.pack("h", self.get_temperature()))
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x01'  # header, sequence number, command identifier
-                                # attribute ID (2 bytes), status (1 byte), data type (1 byte), value (variable length)
-                                '\x00\x00\x00\x29'.format(self.data[1])) + device_temperature
-                            print(device_temperature)
-                            self.send()
-                        # configure reporting '0x06'
-                        elif self.data[2] == 0x06:
-                            # configure reporting response '0x07'
-                            # just responds with success, even though I haven't set up any reporting mechanism!
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x07'  # header, sequence number, command identifier
-                                '\x00'.format(self.data[
-                                                  1]))  # only sending a single ZCL payload byte (0x00) to indicate that all attributes were successfully configured
-                            self.send()
-                        else:
-                            print('general command : %04x not supported' % self.data[2])
-                # 'On/Off' cluster
-                elif self.msg['cluster'] == 0x0006:
-                    # global cluster commands
-                    if self.data[0] & 0b11 == 0b00:
-                        # read attributes '0x00'
-                        if self.data[2] == 0x00:
-                            # read attributes response '0x01'
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x01'  # header, sequence number, command identifier
-                                '\x00\x00\x00\x10{:c}'  # attribute identifier (2 bytes), status (1 byte) data type (1 byte), value (1 byte)
-                                .format(self.data[1], self.on_off_attributes['OnOff']))
-                            self.send()
-                        # configure reporting '0x06'
-                        elif self.data[2] == 0x06:
-                            # configure reporting response '0x07'
-                            # just responds with success, even though I haven't set up any reporting mechanism!
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x07'  # header, sequence number, command identifier
-                                '\x00'  # only sending a single ZCL payload byte (0x00) to indicate that all attributes were successfully configured
-                                .format(self.data[1]))
-                            self.send()
-                        else:
-                            print('general command : %04x not supported' % self.data[2])
-                    # cluster specific commands
-                    elif self.data[0] & 0b11 == 0b01:
-                        self.msg['payload'] = bytearray(
-                            '\x18{:c}\x0b'.format(self.data[1]))  # header, sequence number, command identifier
-                        # off command
-                        if self.data[2] == 0x00:
-                            self.on_off_attributes['OnOff'] = False
-                            self.msg['payload'].extend('\x00\x00')  # command identifier (1 byte), status (1 byte)
-                        # on command
-                        elif self.data[2] == 0x01:
-                            self.on_off_attributes['OnOff'] = True
-                            self.msg['payload'].extend('\x01\x00')  # command identifier (1 byte), status (1 byte)
-                        # toggle command
-                        elif self.data[2] == 0x02:
-                            self.on_off_attributes['OnOff'] = not self.on_off_attributes['OnOff']
-                            self.msg['payload'].extend('\x02\x00')  # command identifier (1 byte), status (1 byte)
-                        self.send()
-                        self.valve.demand()
-                # 'analogue output' cluster
-                elif self.msg['cluster'] == 0x000d:
-                    # global cluster commands
-                    if self.data[0] & 0b11 == 0b00:
-                        # read attributes '0x00'
-                        if self.data[2] == 0x00:
-                            # read attributes response '0x01'
-                            present_value = bytearray(struct.pack("f", self.valve.valve_sensor.rev_counter))
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x01'  # header, sequence number, command identifier
-                                # attribute ID (2 bytes), status (1 byte), data type (1 byte), value (variable length)
-                                '\x1c\x00\x00\x42\x11valve_revolutions'  # Description (variable bytes)
-                                '\x51\x00\x00\x10\x00'  # OutOfService (1 byte)
-                                '\x55\x00\x00\x39'.format(self.data[1])) + present_value + bytearray(
-                                # PresentValue (4 bytes)
-                                '\x6f\x00\x00\x18\x00')  # StatusFlags (1 byte)
-                            self.send()
-                        # configure reporting '0x06'
-                        elif self.data[2] == 0x06:
-                            # configure reporting response '0x07'
-                            # just responds with success, even though I haven't set up any reporting mechanism!
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x07'  # header, sequence number, command identifier
-                                '\x00'.format(self.data[1]))  # only sending a single ZCL payload byte (0x00) to indicate that all attributes were successfully configured
-                            self.send()
-                        else:
-                            print('general command : %04x not supported' % self.data[2])
-                # 'binary input' cluster
-                elif self.msg['cluster'] == 0x000f:
-                    # global cluster commands
-                    if self.data[0] & 0b11 == 0b00:
-                        # read attributes '0x00'
-                        if self.data[2] == 0x00:
-                            # read attributes response '0x01'
-                            present_value = b'\x00'
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x01'  # header, sequence number, command identifier
-                                # attribute ID (2 bytes), status (1 byte), data type (1 byte), value (variable length)
-                                '\x1c\x00\x00\x42\x05awake'  # Description (variable bytes)
-                                '\x51\x00\x00\x10\x00'  # OutOfService (1 byte)
-                                '\x55\x00\x00\x10'.format(self.data[1])) + present_value + bytearray(
-                                # PresentValue (1 byte)
-                                '\x6f\x00\x00\x18\x00')  # StatusFlags (1 byte)
-                            self.send()
-                        # configure reporting '0x06'
-                        elif self.data[2] == 0x06:
-                            # configure reporting response '0x07'
-                            # just responds with success, even though I haven't set up any reporting mechanism!
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x07'  # header, sequence number, command identifier
-                                '\x00'.format(self.data[
-                                                  1]))  # only sending a single ZCL payload byte (0x00) to indicate that all attributes were successfully configured
-                            self.send()
-                        else:
-                            print('general command : %04x not supported' % self.data[2])
+            # ZCL endpoints (valve controller, diagnostics and valve period), dispatched from DEVICE. A broadcast to
+            # all endpoints (0xff), e.g. an OTA image notify, is for the valve controller endpoint.
+            elif (received_msg['dest_ep'] in SIMPLE_DESCRIPTORS) or (received_msg['dest_ep'] == 0xff):
+                if received_msg['dest_ep'] == 0xff:
+                    self.msg['source_ep'] = 0x55
+                handlers = ZCL_HANDLERS.get((self.msg['source_ep'], self.msg['cluster']))
+                if handlers is None:
+                    log.warning('comms', 'cluster: %04x not supported', self.msg['cluster'])
                 else:
-                    print('cluster: %04x not supported' % self.msg['cluster'])
+                    self.process_zcl(handlers[0], handlers[1], handlers[2])
 
             # ---------------------------------------------------------------------------------------------------------------------
             # xbee digi data endpoint
             elif received_msg['dest_ep'] == 0xe8:
                 if (len(self.data) >= 3) and (self.data[0] & 0b11 == 0b00):
-                    cmd = chr(self.data[1]) + chr(self.data[2])
-                    print(cmd)
-                    if len(self.data) == 3:
-                        rsp = xbee.atcmd(cmd)
-                        print(rsp)
-                    else:
-                        rsp = xbee.atcmd(cmd, self.data[3])
-                        print(rsp)
+                    self.optional('maintenance').at_command(self)
                 elif (len(self.data) >= 2) and (self.data[0] & 0b11 == 0b01):
-                    print('TRV command')
+                    if __debug__:
+                        log.debug('comms', 'TRV command %s', chr(self.data[1]))
                     if chr(self.data[1]) == 'P':
                         if len(self.data) > 3:
                             position = (self.data[2] << 8) + self.data[3]
-                            print('goto revs {0}'.format(position))
-                            self.valve.position = position
-                            self.valve.goto_revs()
+                            log.info('comms', 'goto revs %i', position)
+                            self.valve.request_position(position)
                     if chr(self.data[1]) == 'H':
-                        print('home')
                         self.valve.home_valve()
                     if chr(self.data[1]) == 'F':
-                        print('forwards')
                         self.valve.motor.forwards()
                     if chr(self.data[1]) == 'O':
-                        print('open')
-                        self.valve.goto_revs(0)
+                        self.valve.request_position(0)
                     if chr(self.data[1]) == 'C':
-                        print('close')
-                        self.valve.goto_revs(self.valve.closed_position)
+                        self.valve.request_position(self.valve.closed_position)
                     if chr(self.data[1]) == 'S':
-                        print('stop')
                         self.valve.motor.stop_soft()
                     if chr(self.data[1]) == 'G':
-                        print('revs :{0}'.format(self.valve.valve_sensor.rev_counter))
+                        log.info('comms', 'revs :%i', self.valve.valve_sensor.rev_counter)
                         self.send_for_printing(bytearray(struct.pack("f", self.valve.valve_sensor.rev_counter)))
                     if chr(self.data[1]) == 'I':
-                        print('interupt')
                         self.valve.interupt = True
                     if chr(self.data[1]) == 'T':
                         if len(self.data) > 3:
                             self.valve.valve_sensor.set_threshold((self.data[2] << 8) + self.data[3])
-                    if chr(self.data[1]) == 'L':
-                        print('L')
+                    if chr(self.data[1]) == 'R':
+                        # record/replay trace: 0 = stop, 1 = start (optional buffer size, 2 bytes), 2 = dump, 3 = release
+                        if len(self.data) > 2:
+                            if self.data[2] == 0x00:
+                                trace.stop()
+                            elif self.data[2] == 0x01:
+                                if len(self.data) > 4:
+                                    trace.start(self.valve, (self.data[3] << 8) + self.data[4])
+                                else:
+                                    trace.start(self.valve)
+                            elif self.data[2] == 0x02:
+                                trace.dump(self.send_broadcast_digi_data)
+                            elif self.data[2] == 0x03:
+                                trace.release()
+                    if chr(self.data[1]) == 'A':
+                        self.optional('maintenance').at_batch(self, received_msg['sender_eui64'])
                     if chr(self.data[1]) == 'D':
-                        print('D')
+                        # history: level (0 = minutes, 1 = hours, 2 = days), optional first record number
+                        # (4 bytes) and record count
+                        if len(self.data) > 2:
+                            first = 0
+                            count = history.MAX_RESPONSE
+                            if len(self.data) > 6:
+                                first = struct.unpack('>I', bytes(self.data[3:7]))[0]
+                            if len(self.data) > 7:
+                                count = self.data[7]
+                            if self.data[2] < len(history.LEVELS):
+                                # to the sender, a broadcast this long would fail
+                                self.msg['payload'] = b'D' + self.history.query(self.data[2], first, count)
+                                self.send(received_msg['sender_eui64'])
+                    if chr(self.data[1]) == 'V':
+                        # verbosity: level, route (0 = print, 1 = log file), optional module name
+                        if len(self.data) > 3:
+                            module = None
+                            if len(self.data) > 4:
+                                module = bytes(self.data[4:]).decode()
+                            log.set_level(self.data[2], module)
+                            log.route(self.log if self.data[3] else None)
                     if chr(self.data[1]) == 'X':
-                        self.logger.close()
-                        with uio.open(LOG_FILE) as logger:
-                            while True:
-                                line = logger.readline(74)
-                                if not line:
-                                    break
-                                print(line, end="")
-                                self.send_broadcast_digi_data(line)
-                        print("log file read")
-                        uos.remove(LOG_FILE)
-                        self.logger = uio.open(LOG_FILE, mode="a")
-                        self.log('log file created')
+                        self.optional('maintenance').log_dump(self)
+                    if chr(self.data[1]) == 'Z':
+                        # group command, acted on by the members of the group: group ID (2 bytes), then
+                        # 0 = close, 1 = open, 2 = go to position (2 bytes), 3 = recall scene (scene ID)
+                        if (len(self.data) > 4) and self.groups.member((self.data[2] << 8) + self.data[3]):
+                            self.group_command((self.data[2] << 8) + self.data[3], self.data[4], self.data[5:])
                 else:
-                    print('invalid command')
+                    log.warning('comms', 'invalid command')
 
             # ---------------------------------------------------------------------------------------------------------------------
             # endpoint for printing
             elif received_msg['dest_ep'] == 0xf0:  # decimal 240 (last endpoint)
-                print("%s" % received_msg[
-                    'payload'])  # this does not go to the serial terminal it goes to the MicroPython REPL, XCTU has to be set to REPL mode [4] to display the output
-                stdout.write("[serial out] %s" % received_msg['payload'])  # nothing appears on the serial port
-
-            # ---------------------------------------------------------------------------------------------------------------------
-            # endpoint for diagnostics
-            elif received_msg['dest_ep'] == 0x01:
-                # 'analogue output' cluster
-                if self.msg['cluster'] == 0x000d:
-                    # global cluster commands
-                    if self.data[0] & 0b11 == 0b00:
-                        # read attributes '0x00'
-                        if self.data[2] == 0x00:
-                            # read attributes response '0x01'
-                            batt_voltage = bytearray(struct.pack("f", self.battery_voltage_mV()))
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x01'  # header, sequence number, command identifier
-                                # attribute ID (2 bytes), status (1 byte), data type (1 byte), value (variable length)
-                                '\x1c\x00\x00\x42\x0fbattery_voltage'  # Description (variable bytes)
-                                '\x51\x00\x00\x10\x00'  # OutOfService (1 byte)
-                                '\x55\x00\x00\x39'.format(self.data[1])) + batt_voltage + bytearray(
-                                # PresentValue (4 bytes)
-                                '\x6f\x00\x00\x18\x00')  # StatusFlags (1 byte)
-                            self.send()
-                        # configure reporting '0x06'
-                        elif self.data[2] == 0x06:
-                            # configure reporting response '0x07'
-                            # just responds with success, even though I haven't set up any reporting mechanism!
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x07'  # header, sequence number, command identifier
-                                '\x00'.format(self.data[
-                                                  1]))  # only sending a single ZCL payload byte (0x00) to indicate that all attributes were successfully configured
-                            self.send()
-                        else:
-                            print('general command : %04x not supported' % self.data[2])
-                # 'binary input' cluster
-                elif self.msg['cluster'] == 0x000f:
-                    # global cluster commands
-                    if self.data[0] & 0b11 == 0b00:
-                        # read attributes '0x00'
-                        if self.data[2] == 0x00:
-                            # read attributes response '0x01'
-                            present_value = b'\x00'
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x01'  # header, sequence number, command identifier
-                                # attribute ID (2 bytes), status (1 byte), data type (1 byte), value (variable length)
-                                '\x1c\x00\x00\x42\x05awake'  # Description (variable bytes)
-                                '\x51\x00\x00\x10\x00'  # OutOfService (1 byte)
-                                '\x55\x00\x00\x10'.format(self.data[1])) + present_value + bytearray(
-                                # PresentValue (1 byte)
-                                '\x6f\x00\x00\x18\x00')  # StatusFlags (1 byte)
-                            self.send()
-                        # configure reporting '0x06'
-                        elif self.data[2] == 0x06:
-                            # configure reporting response '0x07'
-                            # just responds with success, even though I haven't set up any reporting mechanism!
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x07'  # header, sequence number, command identifier
-                                '\x00'.format(self.data[
-                                                  1]))  # only sending a single ZCL payload byte (0x00) to indicate that all attributes were successfully configured
-                            self.send()
-                        else:
-                            print('general command : %04x not supported' % self.data[2])
-                elif self.msg['cluster'] == 0x0000:
-                    print("%s\n" % self.msg['payload'])
-                else:
-                    print('cluster: %04x not supported' % self.msg['cluster'])
-
-            # ---------------------------------------------------------------------------------------------------------------------
-            # endpoint for valve period
-            elif received_msg['dest_ep'] == 0x02:
-                # 'analogue output' cluster
-                if self.msg['cluster'] == 0x000d:
-                    # global cluster commands
-                    if self.data[0] & 0b11 == 0b00:
-                        # read attributes '0x00'
-                        if self.data[2] == 0x00:
-                            # read attributes response '0x01'
-                            period = bytearray(struct.pack("f", self.valve.valve_sensor.period_filtered))
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x01'  # header, sequence number, command identifier
-                                # attribute ID (2 bytes), status (1 byte), data type (1 byte), value (variable length)
-                                '\x1c\x00\x00\x42\x0cvalve_period'  # Description (variable bytes)
-                                '\x51\x00\x00\x10\x00'  # OutOfService (1 byte)
-                                '\x55\x00\x00\x39'.format(self.data[1])) + period + bytearray(  # PresentValue (4 bytes)
-                                '\x6f\x00\x00\x18\x00')  # StatusFlags (1 byte)
-                            self.send()
-                        # configure reporting '0x06'
-                        elif self.data[2] == 0x06:
-                            # configure reporting response '0x07'
-                            # just responds with success, even though I haven't set up any reporting mechanism!
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x07'  # header, sequence number, command identifier
-                                '\x00'.format(self.data[
-                                                  1]))  # only sending a single ZCL payload byte (0x00) to indicate that all attributes were successfully configured
-                            self.send()
-                        else:
-                            print('general command : %04x not supported' % self.data[2])
-                # 'binary input' cluster
-                elif self.msg['cluster'] == 0x000f:
-                    # global cluster commands
-                    if self.data[0] & 0b11 == 0b00:
-                        # read attributes '0x00'
-                        if self.data[2] == 0x00:
-                            # read attributes response '0x01'
-                            present_value = b'\x00'
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x01'  # header, sequence number, command identifier
-                                # attribute ID (2 bytes), status (1 byte), data type (1 byte), value (variable length)
-                                '\x1c\x00\x00\x42\x05awake'  # Description (variable bytes)
-                                '\x51\x00\x00\x10\x00'  # OutOfService (1 byte)
-                                '\x55\x00\x00\x10'.format(self.data[1])) + present_value + bytearray(
-                                # PresentValue (1 byte)
-                                '\x6f\x00\x00\x18\x00')  # StatusFlags (1 byte)
-                            self.send()
-                        # configure reporting '0x06'
-                        elif self.data[2] == 0x06:
-                            # configure reporting response '0x07'
-                            # just responds with success, even though I haven't set up any reporting mechanism!
-                            self.msg['payload'] = bytearray(
-                                '\x18{:c}\x07'  # header, sequence number, command identifier
-                                '\x00'.format(self.data[
-                                                  1]))  # only sending a single ZCL payload byte (0x00) to indicate that all attributes were successfully configured
-                            self.send()
-                        else:
-                            print('general command : %04x not supported' % self.data[2])
-                elif self.msg['cluster'] == 0x0000:
-                    print("%s\n" % self.msg['payload'])
-                else:
-                    print('cluster: %04x not supported' % self.msg['cluster'])
+                self.optional('maintenance').print_frame(received_msg)
+
+            self.reply_entry = None
+
+    def duplicate_frame(self, received_msg):
+        # When an APS ack is lost the coordinator retries the frame. Frames are keyed on sender, cluster, endpoint and
+        # sequence number (and ZCL command), and a retry gets the original reply sent again instead of being acted on
+        # a second time.
+        if received_msg['dest_ep'] == 0xe8:
+            # digi frames carry no sequence number, so a retry can't be told from the same command sent again
+            return False
+        if received_msg['dest_ep'] == 0x0000:
+            sequence = self.data[0]
+        elif len(self.data) < 3:
+            return False
+        elif self.data[0] & 0b100:
+            if len(self.data) < 5:
+                return False
+            sequence = (self.data[3], self.data[4])  # after the 2 byte manufacturer code
+        else:
+            # with the command identifier, so a response to one of our requests can't be taken for a retry of a
+            # command the same sender numbered independently
+            sequence = (self.data[1], self.data[2])
+        key = (received_msg.get('sender_nwk'), received_msg['cluster'], received_msg['dest_ep'], sequence)
+        now = time.ticks_ms()
+        self.recent_frames = [entry for entry in self.recent_frames
+                              if time.ticks_diff(now, entry[1]) < self.DUPLICATE_EXPIRY]
+        for entry in self.recent_frames:
+            if entry[0] == key:
+                log.info('comms', 'duplicate frame, not handled again')
+                reply = entry[2]
+                if reply is not None:
+                    try:
+                        xbee.transmit(reply[5], reply[0], cluster=reply[1], source_ep=reply[2],
+                                      dest_ep=reply[3], profile=reply[4], bcast_radius=0, tx_options=0)
+                        energy.transmit(len(reply[0]))
+                    except OSError:
+                        log.error('comms', 'OSError - could not send to coordinator')
+                return True
+        self.reply_entry = [key, now, None]
+        self.recent_frames.append(self.reply_entry)
+        if len(self.recent_frames) > self.DUPLICATE_CACHE_SIZE:
+            self.recent_frames.pop(0)
+        return False
+
+    def call(self, handler, *args):
+        # a DEVICE handler is a TRV method, or 'module.function' for one in a module that is only imported when needed
+        if '.' in handler:
+            module, function = handler.split('.')
+            return getattr(self.optional(module), function)(self, *args)
+        return getattr(self, handler)(*args)
+
+    def optional(self, name):
+        # Rarely used handlers (diagnostics, log dump, AT passthrough, printing) live in modules that are imported on
+        # first use and unloaded again once they have been idle for OPTIONAL_IDLE, to keep their bytecode off the heap.
+        self.optional_used = time.ticks_ms()
+        if name not in sys.modules:
+            if __debug__:
+                log.debug('comms', 'loading %s', name)
+        return __import__(name)
+
+    def unload_optional(self):
+        if self.keep_optional or (time.ticks_diff(time.ticks_ms(), self.optional_used) < self.OPTIONAL_IDLE):
+            return
+        unloaded = False
+        for name in OPTIONAL_MODULES:
+            if name in sys.modules:
+                del sys.modules[name]
+                unloaded = True
+        if unloaded:
+            gc.collect()
+            if __debug__:
+                log.debug('comms', 'optional modules unloaded, %i bytes free', gc.mem_free())
+
+    def process_zcl(self, read_handler, write_handler, command_handler):
+        if len(self.data) < 3:
+            log.warning('comms', 'ZCL frame too short: %s', bytes(self.data))
+        # global cluster commands
+        elif self.data[0] & 0b11 == 0b00:
+            # read attributes '0x00'
+            if (self.data[2] == 0x00) and (read_handler is not None):
+                # read attributes response '0x01'
+                self.zcl_response(0x01, self.call(read_handler))
+            # write attributes '0x02'
+            elif (self.data[2] == 0x02) and (write_handler is not None):
+                # write attributes response '0x04'
+                self.zcl_response(0x04, self.write_attributes(write_handler))
+            # configure reporting '0x06'
+            elif self.data[2] == 0x06:
+                # configure reporting response '0x07'
+                # just responds with success, even though I haven't set up any reporting mechanism!
+                # only sending a single ZCL payload byte (0x00) to indicate that all attributes were successfully configured
+                self.zcl_response(0x07, b'\x00')
+            else:
+                log.warning('comms', 'general command : %04x not supported', self.data[2])
+        # cluster specific commands
+        elif (self.data[0] & 0b11 == 0b01) and (command_handler is not None):
+            self.call(command_handler)
+        else:
+            log.warning('comms', 'cluster specific command : %04x not supported', self.data[2])
+
+    def write_attributes(self, write_handler):
+        # write attribute records: attribute ID (2 bytes), data type (1 byte), value (variable length)
+        payload = bytes(self.data)
+        failed = b''
+        index = 3
+        while index + 3 <= len(payload):
+            attribute, data_type = struct.unpack('<HB', payload[index:index + 3])
+            index += 3
+            fmt = ZCL_DATA_TYPES.get(data_type)
+            if fmt is None:
+                # the length of an unknown data type isn't known, so the rest of the frame can't be parsed
+                failed += struct.pack('<BH', 0x8d, attribute)  # status: invalid data type
+                break
+            if index + struct.calcsize(fmt) > len(payload):
+                failed += struct.pack('<BH', 0x80, attribute)  # status: malformed command, the value is cut short
+                break
+            value = struct.unpack(fmt, payload[index:index + struct.calcsize(fmt)])[0]
+            index += struct.calcsize(fmt)
+            status = self.call(write_handler, attribute, data_type, value)
+            if status != 0x00:
+                failed += struct.pack('<BH', status, attribute)
+        # a single success status byte if every attribute was written, otherwise status and ID of those that failed
+        return failed or b'\x00'
+
+    def zcl_response(self, command, records, frame_control=0x18):
+        # header global/cluster-specific (2 bits) manufacturer specific (1 bit) direction (1 bit [1 = server to client]) disable default response (1 bit [0 = default response returned, e.g. 1 used when response frame is a direct effect of a previously recieved frame])
+        # 0x18 for a global command response, 0x19 for a cluster specific one
+        self.msg['payload'] = struct.pack('BBB', frame_control, self.data[1], command) + records
+        self.send()
+
+    # 'basic' cluster
+    def read_basic(self):
+        # Zigpy asks for attributes 4 (manf name) and 5 (model identifier)
+        # '\x00\x00\x00\x20\x02'  # zigby stack version: 02
+        # '\x07\x00\x00\x30\x03'  # power source - 03 = battery
+        return string_record(0x0004, b'TW-Design') + string_record(0x0005, b'MW-Valve')
+
+    # 'power configuration' cluster
+    def read_power_configuration(self):
+        batt_percentage_remaining = attribute_record(0x0021, 0x20, 'B', self.battery_percentage_remaining())
+        if (len(self.data) > 3) and (self.data[3] == 0x21):  # attribute identifier: battery percentage
+            return batt_percentage_remaining
+        return (attribute_record(0x0020, 0x20, 'B', self.battery_voltage())  # battery voltage (1 byte - uint8)
+                + batt_percentage_remaining
+                + attribute_record(0x0031, 0x30, 'B', 0x03))  # battery size: AA
+
+    # 'device temperature configuration' cluster
+    def read_device_temperature(self):
+        return attribute_record(0x0000, 0x29, 'h', self.get_temperature())
+
+    # 'groups' cluster
+    def read_groups(self):
+        return attribute_record(0x0000, 0x18, 'B', 0x00)  # NameSupport: no group names
+
+    def groups_command(self):
+        self.cluster_response(self.groups.groups_command(self.data))
+
+    # 'scenes' cluster
+    def read_scenes(self):
+        groups = self.groups
+        return (attribute_record(0x0000, 0x20, 'B', len(groups.scenes))  # SceneCount
+                + attribute_record(0x0001, 0x20, 'B', groups.current_scene)  # CurrentScene
+                + attribute_record(0x0002, 0x21, 'H', groups.current_group)  # CurrentGroup
+                + attribute_record(0x0003, 0x10, 'B', int(groups.scene_valid))  # SceneValid
+                + attribute_record(0x0004, 0x18, 'B', 0x00))  # NameSupport: no scene names
+
+    def scenes_command(self):
+        self.cluster_response(self.groups.scenes_command(self.data))
+
+    def cluster_response(self, response):
+        # response: (command identifier, payload) of a cluster specific response, a status for a default response,
+        # or None if there isn't one
+        if isinstance(response, int):
+            # default response '0x0b': command identifier (1 byte), status (1 byte)
+            self.zcl_response(0x0b, struct.pack('BB', self.data[2], response))
+        elif response is not None:
+            self.zcl_response(response[0], response[1], 0x19)
+
+    def group_command(self, group, action, value):
+        if action == 0x00:
+            self.move_to(self.valve.closed_position)
+        elif action == 0x01:
+            self.move_to(0)
+        elif (action == 0x02) and (len(value) > 1):
+            self.move_to(min((value[0] << 8) + value[1], self.valve.closed_position))
+        elif (action == 0x03) and value and ((group, value[0]) in self.groups.scenes):
+            self.groups.recall(group, value[0])
+        else:
+            log.warning('comms', 'group command %02x not supported', action)
+
+    def move_to(self, position):
+        # a position set over the network takes the valve out of local control, it moves from the main loop once
+        # any response has gone
+        log.info('comms', 'goto revs %i', position)
+        if self.thermostat.local_control():
+            self.thermostat.set_system_mode(thermostat.SYSTEM_MODE_OFF)
+        self.groups.scene_valid = False
+        self.valve.request_position_later(position)
+
+    # 'On/Off' cluster
+    def read_on_off(self):
+        return attribute_record(0x0000, 0x10, 'B', int(self.on_off_attributes['OnOff']))
+
+    def on_off_command(self):
+        # off command
+        if self.data[2] == 0x00:
+            self.on_off_attributes['OnOff'] = False
+        # on command
+        elif self.data[2] == 0x01:
+            self.on_off_attributes['OnOff'] = True
+        # toggle command
+        elif self.data[2] == 0x02:
+            self.on_off_attributes['OnOff'] = not self.on_off_attributes['OnOff']
+        else:
+            log.warning('comms', 'on/off command : %02x not supported', self.data[2])
+            return
+        if self.thermostat.local_control():
+            # an explicit on/off from HA takes the valve back out of local control
+            self.thermostat.set_system_mode(thermostat.SYSTEM_MODE_OFF)
+        # default response '0x0b': command identifier (1 byte), status (1 byte)
+        self.zcl_response(0x0b, struct.pack('BB', self.data[2], 0x00))
+        self.valve.demand()
+
+    # 'analogue output' cluster
+    def read_valve_revolutions(self):
+        return (analogue_records(b'valve_revolutions', self.valve_present_value())
+                + attribute_record(0x0041, 0x39, 'f', 100 if self.valve_units == UNITS_PERCENT
+                                   else self.valve.closed_position)  # MaxPresentValue
+                + attribute_record(0x0045, 0x39, 'f', 0)  # MinPresentValue
+                + attribute_record(0x0075, 0x31, 'H', self.valve_units))  # EngineeringUnits
+
+    def valve_present_value(self):
+        if self.valve_units == UNITS_PERCENT:
+            return self.valve.percentage_open()
+        return self.valve.valve_sensor.rev_counter
+
+    def write_valve_position(self, attribute, data_type, value):
+        # PresentValue: the valve's target position, moved to from the main loop once the response has gone
+        if attribute == 0x0055:
+            if not self.valve.homing_complete:
+                return 0x01  # status: failure
+            if self.valve_units == UNITS_PERCENT:
+                if not 0 <= value <= 100:
+                    return 0x87  # status: invalid value
+                position = self.valve.position_for_percentage(int(value + 0.5))
+            else:
+                if not 0 <= value <= self.valve.closed_position:
+                    return 0x87  # status: invalid value
+                position = int(value + 0.5)
+            self.move_to(position)
+        # EngineeringUnits: revolutions or percentage open
+        elif attribute == 0x0075:
+            if value not in (UNITS_NONE, UNITS_PERCENT):
+                return 0x87  # status: invalid value
+            self.valve_units = value
+        else:
+            return 0x86  # status: unsupported attribute
+        return 0x00
+
+    def read_travel_eta(self):
+        return analogue_records(b'travel_eta_s', self.valve.eta / 1000)
+
+    # 'OTA upgrade' cluster (client)
+    def ota_command(self):
+        self.ota.handle(self.data, self.msg['dest_ep'])
+
+    # 'binary input' cluster
+    def read_awake(self):
+        return binary_records(b'awake', self.awake_flag)
+
+    # 'thermostat' cluster
+    def read_thermostat(self):
+        return (attribute_record(0x0000, 0x29, 'h', self.get_temperature())  # LocalTemperature
+                + attribute_record(0x0008, 0x20, 'B', self.thermostat.heating_demand)  # PIHeatingDemand
+                + attribute_record(0x0012, 0x29, 'h', self.thermostat.setpoint)  # OccupiedHeatingSetpoint
+                + attribute_record(0x001b, 0x30, 'B', 0x02)  # ControlSequenceOfOperation: heating only
+                + attribute_record(0x001c, 0x30, 'B', self.thermostat.system_mode))  # SystemMode
+
+    def write_thermostat(self, attribute, data_type, value):
+        # OccupiedHeatingSetpoint
+        if attribute == 0x0012:
+            if not self.thermostat.set_setpoint(value):
+                return 0x87  # status: invalid value
+        # SystemMode
+        elif attribute == 0x001c:
+            if not self.thermostat.set_system_mode(value):
+                return 0x87  # status: invalid value
+        else:
+            return 0x86  # status: unsupported attribute
+        return 0x00
 
     def report_attribute(self, cluster, ep):
+        self.reply_entry = None
         self.msg['source_ep'] = ep
         self.msg['dest_ep'] = 0x01
         self.msg['profile'] = 0x0104
@@ -696,7 +890,7 @@ class TRV:
 
             elif cluster == 0x000d:
                 self.msg['cluster'] = 0x000d
-                present_value = bytearray(struct.pack("f", self.valve.valve_sensor.rev_counter))
+                present_value = bytearray(struct.pack("f", self.valve_present_value()))
                 # print(["0x%02x" % b for b in present_value])
                 self.msg['payload'] = bytearray(
                     '\x18\x05\x0a'  # replaced the sequence number with \x05
@@ -719,6 +913,17 @@ class TRV:
                 ) + binary_sensor
                 self.send()
 
+            elif cluster == 0x0201:
+                self.msg['cluster'] = 0x0201
+                self.msg['payload'] = bytearray(
+                    '\x18\x09\x0a'  # header, sequence number, command identifier
+                    # attribute ID (2 bytes), data type (1 byte), value (variable length)
+                ) + struct.pack('<HBh', 0x0000, 0x29, self.get_temperature()) + struct.pack(  # LocalTemperature
+                    '<HBB', 0x0008, 0x20, self.thermostat.heating_demand) + struct.pack(  # PIHeatingDemand
+                    '<HBh', 0x0012, 0x29, self.thermostat.setpoint) + struct.pack(  # OccupiedHeatingSetpoint
+                    '<HBB', 0x001c, 0x30, self.thermostat.system_mode)  # SystemMode
+                self.send()
+
         elif ep == 0x01:
             if cluster == 0x000d:
                 self.msg['cluster'] = 0x000d
@@ -749,3 +954,27 @@ class TRV:
                     # '\x6f\x00\x18\x00'  # StatusFlags (1 byte)
                 ) + period  # PresentValue (4 bytes)
                 self.send()
+
+        elif ep == 0x03:
+            if cluster == 0x000d:
+                self.msg['cluster'] = 0x000d
+                charge_used = bytearray(struct.pack("f", energy.charge_used()))
+                self.msg['payload'] = bytearray(
+                    '\x18\x0a\x0a'
+                    # attribute ID (2 bytes), data type (1 byte), value (variable length)
+                    '\x55\x00'  # attribute identifier
+                    '\x39'  # data type
+                ) + charge_used  # PresentValue (4 bytes)
+                self.send()
+
+        elif ep == 0x04:
+            if cluster == 0x000d:
+                self.msg['cluster'] = 0x000d
+                eta = bytearray(struct.pack("f", self.valve.eta / 1000))
+                self.msg['payload'] = bytearray(
+                    '\x18\x0b\x0a'
+                    # attribute ID (2 bytes), data type (1 byte), value (variable length)
+                    '\x55\x00'  # attribute identifier
+                    '\x39'  # data type
+                ) + eta  # PresentValue (4 bytes), seconds
+                self.send()
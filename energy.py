@@ -0,0 +1,61 @@
+import time
+
+# Accumulated activity counters and the charge they are estimated to have used. The cost model is the current drawn
+# in each state (mA) and the charge per event (mA.ms), and can be tuned to the measured hardware.
+model = {'motor': 120, 'stall': 350, 'awake': 33, 'asleep': 0.003, 'transmit': 160, 'byte': 1.3, 'receive': 20}
+
+counters = {'motor_open_ms': 0, 'motor_close_ms': 0, 'stall_ms': 0, 'transmits': 0, 'bytes_sent': 0, 'receives': 0,
+            'awake_ms': 0, 'asleep_ms': 0}
+
+last_tick = time.ticks_ms()
+
+
+def motor(direction, ms):
+    # direction as Motor.direction: -1 opening, 1 closing
+    if direction < 0:
+        counters['motor_open_ms'] += ms
+    elif direction > 0:
+        counters['motor_close_ms'] += ms
+
+
+def stall(ms):
+    counters['stall_ms'] += ms
+
+
+def transmit(length):
+    counters['transmits'] += 1
+    counters['bytes_sent'] += length
+
+
+def receive():
+    counters['receives'] += 1
+
+
+def tick():
+    # adds the time since the last tick as awake time, called from the main loop
+    global last_tick
+    now = time.ticks_ms()
+    counters['awake_ms'] += time.ticks_diff(now, last_tick)
+    last_tick = now
+
+
+def asleep(ms):
+    # the module has just been asleep for ms, which is not awake time
+    global last_tick
+    now = time.ticks_ms()
+    counters['awake_ms'] += max(time.ticks_diff(now, last_tick) - ms, 0)
+    counters['asleep_ms'] += ms
+    last_tick = now
+
+
+def charge_used():
+    # estimated charge used since boot, mAh
+    motor_ms = counters['motor_open_ms'] + counters['motor_close_ms']
+    charge = ((motor_ms - counters['stall_ms']) * model['motor']
+              + counters['stall_ms'] * model['stall']
+              + counters['awake_ms'] * model['awake']
+              + counters['asleep_ms'] * model['asleep']
+              + counters['transmits'] * model['transmit']
+              + counters['bytes_sent'] * model['byte']
+              + counters['receives'] * model['receive'])
+    return charge / 3600000
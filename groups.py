@@ -0,0 +1,194 @@
+import struct
+import uio
+import log
+
+# ZCL Groups (0x0004) and Scenes (0x0005) server for the valve endpoint. Group membership and scenes (the valve
+# position stored for a group and scene ID) are kept in GROUPS_FILE, so they survive a reset. ZCL multicasts can't be
+# told apart by group (see ZHA_comms.GROUP_IGNORED), so the clusters aren't advertised and a group is moved with the
+# TRV 'Z' command, which carries the group ID and is acted on by the members of that group only.
+GROUPS_FILE = 'groups.dat'
+MAX_GROUPS = 8
+MAX_SCENES = 16
+
+# ZCL status
+SUCCESS = 0x00
+MALFORMED_COMMAND = 0x80
+INVALID_FIELD = 0x85
+INSUFFICIENT_SPACE = 0x89
+DUPLICATE_EXISTS = 0x8a
+NOT_FOUND = 0x8b
+
+
+class Groups:
+    current_scene = 0
+    current_group = 0
+    scene_valid = False
+
+    def __init__(self, trv):
+        self.trv = trv
+        self.groups = []
+        self.scenes = {}  # (group, scene): valve position
+        try:
+            with uio.open(GROUPS_FILE, mode='rb') as stored:
+                data = stored.read()
+            count = data[0]
+            self.groups = list(struct.unpack_from('<%iH' % count, data, 1))
+            index = 1 + 2 * count
+            for scene in range(data[index]):
+                group, scene_id, position = struct.unpack_from('<HBh', data, index + 1 + 5 * scene)
+                self.scenes[(group, scene_id)] = position
+        except (OSError, IndexError, ValueError):
+            pass  # no groups yet
+
+    def save(self):
+        data = struct.pack('<B%iH' % len(self.groups), len(self.groups), *self.groups)
+        data += struct.pack('B', len(self.scenes))
+        for (group, scene), position in self.scenes.items():
+            data += struct.pack('<HBh', group, scene, position)
+        with uio.open(GROUPS_FILE, mode='wb') as stored:
+            stored.write(data)
+
+    def member(self, group):
+        return group in self.groups
+
+    def groups_command(self, data):
+        # returns (response command, payload), a status for a default response, or None when the command has no
+        # response
+        payload = bytes(data[3:])
+        command = data[2]
+        if (command in (0x00, 0x01, 0x03, 0x05)) and (len(payload) < 2):
+            return MALFORMED_COMMAND  # no group ID
+        # add group (and add group if identifying, which is the same here as the valve has no identify mode)
+        if command in (0x00, 0x05):
+            group = struct.unpack_from('<H', payload)[0]
+            if group in self.groups:
+                status = DUPLICATE_EXISTS
+            elif len(self.groups) >= MAX_GROUPS:
+                status = INSUFFICIENT_SPACE
+            else:
+                self.groups.append(group)
+                self.save()
+                log.info('comms', 'added to group %04x', group)
+                status = SUCCESS
+            if command == 0x05:
+                return None
+            return 0x00, struct.pack('<BH', status, group)
+        # view group: status, group ID, name (names aren't supported, so always empty)
+        if command == 0x01:
+            group = struct.unpack_from('<H', payload)[0]
+            return 0x01, struct.pack('<BHB', SUCCESS if group in self.groups else NOT_FOUND, group, 0)
+        # get group membership: capacity, count and group IDs, of those asked about or of all if none are
+        if command == 0x02:
+            if payload and (len(payload) < 1 + 2 * payload[0]):
+                return MALFORMED_COMMAND
+            asked = struct.unpack_from('<%iH' % payload[0], payload, 1) if payload and payload[0] else self.groups
+            found = [group for group in asked if group in self.groups]
+            return 0x02, struct.pack('<BB%iH' % len(found), MAX_GROUPS - len(self.groups), len(found), *found)
+        # remove group, and its scenes
+        if command == 0x03:
+            group = struct.unpack_from('<H', payload)[0]
+            if group not in self.groups:
+                return 0x03, struct.pack('<BH', NOT_FOUND, group)
+            self.groups.remove(group)
+            self.remove_scenes(group)
+            self.save()
+            return 0x03, struct.pack('<BH', SUCCESS, group)
+        # remove all groups
+        if command == 0x04:
+            for group in self.groups:
+                self.remove_scenes(group)
+            self.groups = []
+            self.save()
+            return None
+        log.warning('comms', 'groups command : %02x not supported', command)
+        return None
+
+    def scenes_command(self, data):
+        # returns (response command, payload), a status for a default response, or None when the command has no
+        # response
+        payload = bytes(data[3:])
+        command = data[2]
+        if command == 0x00:
+            needed = 6 + (payload[5] if len(payload) > 5 else 0)  # group and scene ID, transition time and name
+        elif command in (0x03, 0x06):
+            needed = 2  # group ID
+        else:
+            needed = 3  # group and scene ID
+        if len(payload) < needed:
+            return MALFORMED_COMMAND
+        group = struct.unpack_from('<H', payload)[0]
+        # scenes can be in group 0, or in a group the valve is a member of
+        known_group = (group == 0) or (group in self.groups)
+        # get scene membership: status, capacity, group ID, scene count and IDs
+        if command == 0x06:
+            if not known_group:
+                return 0x06, struct.pack('<BBH', INVALID_FIELD, MAX_SCENES - len(self.scenes), group)
+            scenes = [scene for (scene_group, scene) in self.scenes if scene_group == group]
+            return 0x06, struct.pack('<BBHB', SUCCESS, MAX_SCENES - len(self.scenes), group, len(scenes)) + bytes(
+                scenes)
+        # remove all scenes
+        if command == 0x03:
+            if known_group:
+                self.remove_scenes(group)
+                self.save()
+            return 0x03, struct.pack('<BH', SUCCESS if known_group else INVALID_FIELD, group)
+        scene = payload[2]
+        key = (group, scene)
+        if not known_group:
+            status = INVALID_FIELD
+        # add scene: group ID, scene ID, transition time, name, extension field sets. The on/off extension field
+        # (cluster 0x0006) sets the position to fully open or closed, otherwise the current position is stored.
+        elif command == 0x00:
+            position = self.trv.valve.position
+            index = 6 + payload[5]  # after the name
+            while index + 3 <= len(payload):
+                cluster, length = struct.unpack_from('<HB', payload, index)
+                if (cluster == 0x0006) and (length >= 1) and (index + 3 < len(payload)):
+                    position = 0 if payload[index + 3] else self.trv.valve.closed_position
+                index += 3 + length
+            status = self.add_scene(key, position)
+        # view scene: transition time, name and extension field sets aren't kept, so only the status is meaningful
+        elif command == 0x01:
+            if key not in self.scenes:
+                return 0x01, struct.pack('<BHB', NOT_FOUND, group, scene)
+            return 0x01, struct.pack('<BHBHBHBB', SUCCESS, group, scene, 0, 0, 0x0006, 1,
+                                     int(self.scenes[key] < self.trv.valve.closed_position))
+        # remove scene
+        elif command == 0x02:
+            status = NOT_FOUND
+            if key in self.scenes:
+                del self.scenes[key]
+                self.save()
+                status = SUCCESS
+        # store scene: the valve's current target position
+        elif command == 0x04:
+            status = self.add_scene(key, self.trv.valve.position)
+        # recall scene
+        elif command == 0x05:
+            if key in self.scenes:
+                self.recall(group, scene)
+            return None
+        else:
+            log.warning('comms', 'scenes command : %02x not supported', command)
+            return None
+        return command, struct.pack('<BHB', status, group, scene)
+
+    def add_scene(self, key, position):
+        if (key not in self.scenes) and (len(self.scenes) >= MAX_SCENES):
+            return INSUFFICIENT_SPACE
+        self.scenes[key] = position
+        self.save()
+        self.current_group, self.current_scene = key
+        self.scene_valid = True
+        return SUCCESS
+
+    def remove_scenes(self, group):
+        for key in [key for key in self.scenes if key[0] == group]:
+            del self.scenes[key]
+
+    def recall(self, group, scene):
+        log.info('comms', 'recall scene %02x of group %04x', scene, group)
+        self.trv.move_to(self.scenes[(group, scene)])
+        self.current_group = group
+        self.current_scene = scene
+        self.scene_valid = True
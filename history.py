@@ -0,0 +1,114 @@
+import struct
+import time
+import uio
+
+# Downsampled history of battery voltage, device temperature and the valve's filtered revolution period. Samples are
+# aggregated into minutes, minutes into hours and hours into days, and each level keeps the minimum, mean and maximum
+# of every series in a ring of fixed size. Records are numbered from 1 per level, so record n is in slot
+# (n - 1) % slots. The minutes are kept in RAM; the hours and days are in files on flash, so they survive a reset,
+# and each of their records is written once.
+RECORD_FORMAT = '<Ihhhhhhhhh'  # record number, then minimum, mean and maximum of each series
+RECORD_SIZE = 22
+SERIES = 3  # battery voltage (mV), device temperature (1/100 degree), filtered revolution period (ms)
+SAMPLE_INTERVAL = 10000  # milliseconds
+# (file, or None for RAM, slots, records of the level below in each record)
+LEVELS = ((None, 60, 6),  # minutes, from samples
+          ('history.h', 168, 60),  # hours: a week
+          ('history.d', 90, 24))  # days
+MAX_RESPONSE = 3  # records in one response frame, 73 bytes so it fits an unfragmented frame
+
+
+class Ring:
+    def __init__(self, name, slots):
+        self.name = name
+        self.slots = slots
+        self.newest = 0
+        if name is None:
+            self.buffer = bytearray(slots * RECORD_SIZE)
+            return
+        try:
+            with uio.open(name, mode='rb') as ring:
+                for slot in range(slots):
+                    record = ring.read(RECORD_SIZE)
+                    if len(record) < RECORD_SIZE:
+                        break
+                    self.newest = max(self.newest, struct.unpack_from('<I', record)[0])
+        except OSError:
+            # allocated full size once, so records can be written in place
+            with uio.open(name, mode='wb') as ring:
+                for slot in range(slots):
+                    ring.write(bytes(RECORD_SIZE))
+
+    def append(self, values):
+        self.newest += 1
+        offset = ((self.newest - 1) % self.slots) * RECORD_SIZE
+        if self.name is None:
+            struct.pack_into(RECORD_FORMAT, self.buffer, offset, self.newest, *values)
+            return
+        with uio.open(self.name, mode='r+b') as ring:
+            ring.seek(offset)
+            ring.write(struct.pack(RECORD_FORMAT, self.newest, *values))
+
+    def oldest(self):
+        return max(self.newest - self.slots + 1, 1)
+
+    def read(self, first, count):
+        # records first onwards, oldest first, as stored
+        first = max(first, self.oldest())
+        last = min(first + count - 1, self.newest)
+        records = b''
+        if self.name is None:
+            for number in range(first, last + 1):
+                offset = ((number - 1) % self.slots) * RECORD_SIZE
+                records += self.buffer[offset:offset + RECORD_SIZE]
+            return records
+        with uio.open(self.name, mode='rb') as ring:
+            for number in range(first, last + 1):
+                ring.seek(((number - 1) % self.slots) * RECORD_SIZE)
+                records += ring.read(RECORD_SIZE)
+        return records
+
+
+class History:
+    def __init__(self, trv):
+        self.trv = trv
+        self.rings = [Ring(name, slots) for name, slots, per_record in LEVELS]
+        # aggregate of the record being built at each level: count, then minimum, sum of means, maximum per series
+        self.counts = [0] * len(LEVELS)
+        self.aggregates = [[0] * (3 * SERIES) for level in LEVELS]
+        self.next_sample = time.ticks_ms()
+
+    def update(self):
+        # called from the main loop
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self.next_sample) < 0:
+            return
+        self.next_sample = time.ticks_add(now, SAMPLE_INTERVAL)
+        values = (self.trv.battery_voltage_mV(), self.trv.get_temperature(),
+                  int(self.trv.valve.valve_sensor.period_filtered))
+        self.add(0, values, values, values)
+
+    def add(self, level, minimums, means, maximums):
+        aggregate = self.aggregates[level]
+        first = self.counts[level] == 0
+        for series in range(SERIES):
+            if first or (minimums[series] < aggregate[3 * series]):
+                aggregate[3 * series] = minimums[series]
+            aggregate[3 * series + 1] = means[series] + (0 if first else aggregate[3 * series + 1])
+            if first or (maximums[series] > aggregate[3 * series + 2]):
+                aggregate[3 * series + 2] = maximums[series]
+        self.counts[level] += 1
+        if self.counts[level] < LEVELS[level][2]:
+            return
+        for series in range(SERIES):
+            aggregate[3 * series + 1] //= self.counts[level]
+        self.counts[level] = 0
+        self.rings[level].append(aggregate)
+        if level + 1 < len(LEVELS):
+            self.add(level + 1, aggregate[0::3], aggregate[1::3], aggregate[2::3])
+
+    def query(self, level, first, count):
+        # level, newest record number, record count (1 byte each, except the number), then the records
+        ring = self.rings[level]
+        records = ring.read(first, min(count, MAX_RESPONSE))
+        return struct.pack('<BIB', level, ring.newest, len(records) // RECORD_SIZE) + records
@@ -0,0 +1,208 @@
+# Valve motion benchmark: runs the real Valve and Sensor code against a model of the motor turning the sensor magnet
+# between the valve's end-stops, over a set of scenarios, and prints a table of metrics (and writes them as JSON),
+# so motion control changes can be compared between revisions on numbers. When homing fails the valve doesn't move,
+# so the metrics of its moves and re-homing are missing ('-' in the table, null in the JSON), not zero.
+#
+#     python host/bench.py [<scenario> ...] [--json <results.json>]
+import importlib
+import io
+import json
+import random
+import struct
+import sys
+
+import sim
+
+sim.install()
+
+import machine
+import xbee
+import trace
+import energy
+import log
+import ZHA_comms
+import valve
+import thermostat
+import groups
+
+
+class ValveModel:
+    TRAVEL = 360  # revolutions between the end-stops
+    RATE = 14.0  # revolutions per second at 3000 mV
+    SLOW = 0.25  # speed at the motor's slow PWM duty, as a fraction of full speed
+    PULSE = 0.3  # fraction of a revolution the sensor reads high
+    HIGH = 3000
+    LOW = 200
+    SAMPLE_MS = 1  # time one pass of the sensor loop takes
+
+    def __init__(self, valve, battery_mV, noise, sticky, seed):
+        self.valve = valve
+        self.battery_mV = battery_mV
+        self.noise = noise
+        self.sticky = sticky  # ((from, to, speed factor), ...) in revolutions from the open end-stop
+        self.block = None  # revolutions from the open end-stop that closing can't get past
+        self.random = random.Random(seed)
+        self.position = self.TRAVEL / 3
+        self.blocked_since = None
+        self.events = []  # (ticks, PresentValue) writes delivered during the run
+        self.stall_delays = []
+        self.reversals = 0
+        self.last_direction = 0
+
+    def read(self):
+        sim.clock.advance(self.SAMPLE_MS)
+        while self.events and (self.events[0][0] <= sim.clock.now):
+            write_position(self.events.pop(0)[1])
+        direction = self.valve.motor.direction
+        if direction:
+            speed = self.RATE * self.battery_mV / 3000 * self.SAMPLE_MS / 1000
+            if self.valve.motor.slow:
+                speed *= self.SLOW
+            for start, end, factor in self.sticky:
+                if start <= self.position < end:
+                    speed *= factor
+            new = self.position + direction * speed
+            if (new < 0) or (new > self.TRAVEL) or (
+                    (self.block is not None) and (direction > 0) and (self.position <= self.block < new)):
+                if self.blocked_since is None:
+                    self.blocked_since = sim.clock.now
+            else:
+                self.position = new
+                self.blocked_since = None
+        value = self.HIGH if (self.position % 1.0) < self.PULSE else self.LOW
+        value += self.random.gauss(0, self.noise) if self.noise else 0
+        return int(min(max(value, 0), 4095))
+
+    def motor(self, direction):
+        # from the firmware's trace hook, on every direction change
+        if (direction == 0) and (self.blocked_since is not None):
+            self.stall_delays.append(sim.clock.now - self.blocked_since)
+            self.blocked_since = None
+        if direction and self.last_direction and (direction != self.last_direction):
+            self.reversals += 1
+        if direction:
+            self.last_direction = direction
+
+
+def write_position(position):
+    # ZCL write attributes to the valve's analogue output PresentValue
+    xbee.deliver(b'\x00\x01\x02\x55\x00\x39' + struct.pack('<f', position), 0x000d, 0x01, 0x55)
+
+
+# name: battery mV, ADC noise, sticky spots, blockage after homing, targets (fractions of closed_position),
+# PresentValue writes during the moves (ms after homing, fraction of closed_position)
+SCENARIOS = {
+    'baseline': (3000, 50, (), None, (1.0, 0.0, 0.5, 0.25), ()),
+    'noisy': (3000, 400, (), None, (1.0, 0.0, 0.5, 0.25), ()),
+    'low_battery': (2300, 50, (), None, (1.0, 0.0, 0.5, 0.25), ()),
+    'sticky': (3000, 50, ((100, 110, 0.3), (200, 203, 0.1)), None, (1.0, 0.0, 0.5, 0.25), ()),
+    'hard_stall': (3000, 50, (), 200, (0.0, 1.0), ()),
+    'mid_move': (3000, 50, (), None, (1.0,), ((5000, 0.3), (9000, 0.6))),
+}
+
+
+# metrics measured on the moves after homing, so only meaningful once homing succeeded
+MOVE_METRICS = ('move_s', 'position_error', 'overshoot', 'missed_revs', 'rehome_s', 'rehome_stop_ms', 'rehome_stall_s')
+
+
+def run(name):
+    battery_mV, noise, sticky, block, targets, writes = SCENARIOS[name]
+    # a fresh valve: its state and the energy counters are module and class attributes
+    importlib.reload(energy)
+    importlib.reload(valve)
+    sim.clock.now = 0
+    del xbee.received[:]
+    del xbee.transmitted[:]
+    trv = ZHA_comms.TRV()
+    trv.logger = io.StringIO()
+    trv.valve = valve.Valve(trv)
+    trv.thermostat = thermostat.Thermostat(trv, trv.valve)
+    trv.groups = groups.Groups(trv)
+    model = ValveModel(trv.valve, battery_mV, noise, sticky, seed=1)
+    machine.ADC.sources['D3'] = model.read
+    machine.ADC.sources['D2'] = battery_mV * 4096 // xbee.at['%V']
+    trace.recording = True
+    trace.sample = lambda value, threshold: None
+    trace.frame = lambda received_msg: None
+    trace.motor = model.motor
+
+    trv.valve.home_valve()
+    homing_ms = sim.clock.now
+    offset = model.position - trv.valve.valve_sensor.rev_counter  # physical position of rev counter 0
+    model.block = block
+    model.events = [(homing_ms + at, int(fraction * trv.valve.closed_position)) for at, fraction in writes]
+    move_ms = []
+    errors = []
+    overshoots = []
+    for fraction in targets:
+        target = int(fraction * trv.valve.closed_position)
+        started = sim.clock.now
+        trv.valve.request_position(target)
+        while model.events or (trv.valve.pending_position is not None) or xbee.received:
+            # writes due after the move ended
+            if model.events and not xbee.received:
+                at, position = model.events.pop(0)
+                sim.clock.now = max(sim.clock.now, at)
+                write_position(position)
+            trv.process_msg()
+            trv.valve.update()
+        move_ms.append(sim.clock.now - started)
+        error = model.position - (trv.valve.position + offset)
+        errors.append(abs(error))
+        overshoots.append(max(0, error * model.last_direction))  # past the target in the direction of travel
+    counters = energy.counters
+    results = {
+        'homed': int(trv.valve.homing_complete),
+        'homing_s': homing_ms / 1000,
+        'move_s': sum(move_ms) / len(move_ms) / 1000,
+        'position_error': sum(errors) / len(errors),
+        'overshoot': max(overshoots),
+        'reversals': model.reversals,
+        'stall_delay_ms': sum(model.stall_delays) / len(model.stall_delays) if model.stall_delays else 0,
+        'missed_revs': abs(trv.valve.valve_sensor.rev_counter + offset - model.position),
+        'motor_s': (counters['motor_open_ms'] + counters['motor_close_ms']) / 1000,
+        'stall_s': counters['stall_ms'] / 1000,
+        'charge_mAh': energy.charge_used(),
+    }
+    # homing again, now the counter and closed_position are known
+    stalls = len(model.stall_delays)
+    stall_ms = counters['stall_ms']
+    if trv.valve.homing_complete:
+        trv.valve.home_valve()
+    trace.recording = False
+    results['rehome_s'] = trv.valve.homing_time / 1000
+    results['rehome_stop_ms'] = sum(model.stall_delays[stalls:])
+    results['rehome_stall_s'] = (counters['stall_ms'] - stall_ms) / 1000
+    if not results['homed']:
+        for metric in MOVE_METRICS:
+            results[metric] = None
+    return results
+
+
+def main(names, json_path):
+    log.set_level(log.OFF)
+    results = {}
+    for name in names:
+        results[name] = run(name)
+    columns = list(results[names[0]])
+    print('%-12s' % 'scenario' + ''.join('%15s' % column for column in columns))
+    for name in names:
+        values = [results[name][column] for column in columns]
+        print('%-12s' % name + ''.join('%15s' % '-' if value is None else '%15.2f' % value for value in values))
+    if json_path:
+        with open(json_path, 'w') as out:
+            json.dump(results, out, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    json_path = None
+    if '--json' in arguments:
+        index = arguments.index('--json')
+        json_path = arguments[index + 1]
+        del arguments[index:index + 2]
+    unknown = [name for name in arguments if name not in SCENARIOS]
+    if unknown:
+        print('unknown scenario: %s, one of: %s' % (', '.join(unknown), ', '.join(SCENARIOS)))
+        sys.exit(2)
+    main(arguments or list(SCENARIOS), json_path)
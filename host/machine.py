@@ -0,0 +1,54 @@
+# machine stand-in for the host simulator
+
+
+class Reset(Exception):
+    pass
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    def __init__(self, name, mode=IN, pull=None):
+        self.name = name
+        self.level = 0
+
+    def on(self):
+        self.level = 1
+
+    def off(self):
+        self.level = 0
+
+    def value(self, level=None):
+        if level is None:
+            return self.level
+        self.level = level
+
+
+class ADC:
+    # readings come from ADC.sources[pin], a number or a callable, so a simulation can model what is wired to the pin
+    sources = {}
+
+    def __init__(self, name):
+        self.name = name
+
+    def read(self):
+        source = self.sources.get(self.name, 0)
+        return source() if callable(source) else source
+
+
+class PWM:
+    def __init__(self, pin):
+        self.pin = pin
+        self.level = 0
+
+    def duty(self, level=None):
+        if level is None:
+            return self.level
+        self.level = level
+
+
+def reset():
+    raise Reset()
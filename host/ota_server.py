@@ -0,0 +1,148 @@
+# Stand-in ZCL OTA upgrade server (cluster 0x0019) for the host simulator, and the builder for upgrade images.
+#
+#     python host/ota_server.py build <file version> <image.ota> <file.py> [<file.py> ...]
+#         packs device modules into an upgrade image for the coordinator's OTA provider
+#     python host/ota_server.py simulate [<loss>]
+#         upgrades a simulated valve to an image of this repository's modules, over a link that loses the given
+#         fraction of frames, and checks the files it swaps in
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import hashlib
+
+import sim
+
+sim.install()
+
+import machine
+import xbee
+import ota
+
+
+def build_image(files, version, manufacturer_code=ota.MANUFACTURER_CODE, image_type=ota.IMAGE_TYPE):
+    elements = b''
+    for path in files:
+        name = os.path.basename(path).encode()
+        with open(path, 'rb') as source:
+            contents = source.read()
+        elements += struct.pack('<HIB', ota.TAG_FILE, 1 + len(name) + len(contents), len(name)) + name + contents
+    size = ota.HEADER_LENGTH + len(elements) + 6 + 32
+    header = struct.pack(ota.HEADER_FORMAT, ota.MAGIC, 0x0100, ota.HEADER_LENGTH, 0x0000, manufacturer_code,
+                         image_type, version, 0x0002, b'MW-Valve firmware'.ljust(32, b'\x00'), size)
+    image = header + elements
+    return image + struct.pack('<HI', ota.TAG_DIGEST, 32) + hashlib.sha256(image).digest()
+
+
+class OtaServer:
+    endpoint = 0x01
+    client_ep = 0x55
+
+    def __init__(self, image, loss=0.0, seed=1):
+        header = struct.unpack(ota.HEADER_FORMAT, image[:ota.HEADER_LENGTH])
+        self.image = image
+        self.manufacturer_code = header[4]
+        self.image_type = header[5]
+        self.version = header[6]
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.sequence = 0
+        self.blocks = 0
+        self.dropped = 0
+        self.block_sizes = []
+        self.end_status = None
+
+    def __call__(self, frame):
+        if frame['cluster'] != ota.OTA_CLUSTER:
+            return
+        if self.random.random() < self.loss:
+            self.dropped += 1  # lost over the air, in either direction
+            return
+        data = frame['payload']
+        sequence, command = data[1], data[2]
+        # query next image request
+        if command == 0x01:
+            manufacturer, image_type, version = struct.unpack('<HHI', data[4:12])
+            if (manufacturer, image_type) == (self.manufacturer_code, self.image_type) and version < self.version:
+                self.reply(sequence, 0x02, struct.pack('<BHHII', ota.SUCCESS, self.manufacturer_code,
+                                                       self.image_type, self.version, len(self.image)))
+            else:
+                self.reply(sequence, 0x02, struct.pack('B', ota.NO_IMAGE_AVAILABLE))
+        # image block request
+        elif command == 0x03:
+            version, offset, size = struct.unpack('<IIB', data[8:17])
+            block = self.image[offset:offset + size]
+            self.blocks += 1
+            self.block_sizes.append(len(block))
+            self.reply(sequence, 0x05, struct.pack('<BHHIIB', ota.SUCCESS, self.manufacturer_code, self.image_type,
+                                                   version, offset, len(block)) + block)
+        # upgrade end request
+        elif command == 0x06:
+            self.end_status = data[3]
+            if self.end_status == ota.SUCCESS:
+                # current time and upgrade time the same: upgrade now
+                self.reply(sequence, 0x07, struct.pack('<HHIII', self.manufacturer_code, self.image_type,
+                                                       self.version, 0, 0))
+
+    def notify(self):
+        # image notify, payload type 0 (query jitter only)
+        self.sequence = (self.sequence + 1) & 0xff
+        self.reply(self.sequence, 0x00, struct.pack('BB', 0x00, 100))
+
+    def reply(self, sequence, command, payload):
+        # cluster specific, server to client, default response disabled
+        xbee.deliver(struct.pack('BBB', 0x19, sequence, command) + payload, ota.OTA_CLUSTER, self.endpoint,
+                     self.client_ep)
+
+
+def simulate(loss):
+    import ZHA_comms
+    import valve
+    import thermostat
+
+    files = sorted(os.path.join(sim.ROOT, name) for name in os.listdir(sim.ROOT) if name.endswith('.py'))
+    image = build_image(files, ota.DEFAULT_VERSION + 1)
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)  # the device writes its staging and swapped files to the current directory
+    for path in files:
+        with open(os.path.basename(path), 'w') as old:
+            old.write('# old version\n')
+
+    trv = ZHA_comms.TRV()
+    trv.valve = valve.Valve(trv)
+    trv.thermostat = thermostat.Thermostat(trv, trv.valve)
+    trv.ota = ota.Ota(trv)
+    server = OtaServer(image, loss)
+    xbee.peers.append(server)
+    server.notify()
+    upgraded = False
+    try:
+        while sim.clock.now < 3600000:
+            trv.process_msg()
+            trv.ota.update()
+            sim.clock.advance(10)
+    except machine.Reset:
+        upgraded = True
+
+    swapped = all(open(os.path.basename(path), 'rb').read() == open(path, 'rb').read() for path in files)
+    print('image: %i bytes, %i files' % (len(image), len(files)))
+    print('upgraded: %s after %.1f s, files swapped: %s, version: %08x' % (
+        upgraded, sim.clock.now / 1000, swapped, ota.current_version()))
+    print('block requests answered: %i, frames lost: %i, block size min/max: %i/%i' % (
+        server.blocks, server.dropped, min(server.block_sizes), max(server.block_sizes)))
+    os.chdir(sim.ROOT)
+    shutil.rmtree(workdir)
+    return upgraded and swapped
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 4) and (sys.argv[1] == 'build'):
+        with open(sys.argv[3], 'wb') as out:
+            out.write(build_image(sys.argv[4:], int(sys.argv[2], 0)))
+    elif (len(sys.argv) > 1) and (sys.argv[1] == 'simulate'):
+        sys.exit(0 if simulate(float(sys.argv[2]) if len(sys.argv) > 2 else 0.0) else 1)
+    else:
+        print('usage: ota_server.py build <file version> <image.ota> <file.py> [...] | simulate [<loss>]')
+        sys.exit(2)
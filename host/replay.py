@@ -0,0 +1,166 @@
+# Replays a trace recorded on a valve (TRV command 'R') through the real TRV, Valve and Sensor code in the host
+# simulator. ADC readings and received frames come from the trace and the virtual clock follows their timestamps,
+# so a replay is deterministic and runs as fast as the host can. The motor direction changes of the replay are
+# checked against the recorded ones, so a field recording doubles as a regression test.
+#
+#     python host/replay.py <trace.bin> [--profile]
+#
+# trace.bin is the trace buffer, assemble() rebuilds it from the payloads of the 'R' dump frames.
+import io
+import struct
+import sys
+import time as host_time
+
+import sim
+
+sim.install()
+
+import machine
+import xbee
+import trace
+import ZHA_comms
+import valve
+import thermostat
+import ota
+import groups
+
+
+class EndOfTrace(Exception):
+    pass
+
+
+def assemble(chunks):
+    # chunks: payloads of the dump frames, 'R', offset (2 bytes), data
+    data = bytearray()
+    for chunk in chunks:
+        offset = struct.unpack_from('<H', chunk, 1)[0]
+        part = chunk[3:]
+        if len(data) < offset + len(part):
+            data.extend(bytes(offset + len(part) - len(data)))
+        data[offset:offset + len(part)] = part
+    return bytes(data)
+
+
+class Replay:
+    def __init__(self, data):
+        events = list(trace.records(data))
+        self.snapshot = [values for ticks, kind, values in events if kind == trace.SNAPSHOT][0]
+        self.samples = []
+        # the skipped readings repeat the previous recorded one, spread evenly until the next
+        previous = (events[0][0], 0)
+        for ticks, kind, values in events:
+            if kind == trace.SAMPLE:
+                value, skipped = values
+                for index in range(skipped):
+                    self.samples.append((previous[0] + (ticks - previous[0]) * (index + 1) // (skipped + 1),
+                                         previous[1]))
+                self.samples.append((ticks, value))
+                previous = (ticks, value)
+        self.frames = [(ticks, values) for ticks, kind, values in events if kind == trace.FRAME]
+        self.recorded_motor = [(ticks, values[0]) for ticks, kind, values in events if kind == trace.MOTOR]
+        self.replayed_motor = []
+        self.start = events[0][0]
+        self.end = events[-1][0]
+        self.sample_index = 0
+        self.frame_index = 0
+
+        self.trv = ZHA_comms.TRV()
+        self.valve = valve.Valve(self.trv)
+        self.trv.valve = self.valve
+        self.trv.thermostat = thermostat.Thermostat(self.trv, self.valve)
+        self.trv.ota = ota.Ota(self.trv)
+        self.trv.groups = groups.Groups(self.trv)
+        self.trv.logger = io.StringIO()
+        sensor = self.valve.valve_sensor
+        (sensor.rev_counter, self.valve.position, self.valve.closed_position, sensor.peek_period,
+         sensor.period_filtered, sensor.THRESHOLD, direction, self.valve.homing_complete, self.valve.drift_rate,
+         self.valve.revs_since_calibration, self.valve.slow_period, battery_mV, rates) = self.snapshot
+        # learned state, so stall detection uses the same limits as on the device
+        self.valve.rate = valve.TravelRate()
+        self.valve.rate.rates = rates
+        # battery readings aren't traced, the one taken when recording started selects the travel rate band
+        self.valve.battery_mV = battery_mV
+        self.trv.battery_voltage_mV = lambda: battery_mV
+        if direction != 0:
+            print('warning: the recording started while the motor was running, that move is not replayed')
+
+    def read_adc(self):
+        if self.sample_index >= len(self.samples):
+            raise EndOfTrace()
+        ticks, value = self.samples[self.sample_index]
+        self.sample_index += 1
+        sim.clock.now = max(sim.clock.now, ticks)
+        return value
+
+    def receive(self):
+        if (self.frame_index >= len(self.frames)) or (self.frames[self.frame_index][0] > sim.clock.now):
+            return None
+        ticks, (cluster, source_ep, dest_ep, profile, sender_nwk, length, payload) = self.frames[self.frame_index]
+        self.frame_index += 1
+        return {'sender_nwk': sender_nwk, 'sender_eui64': bytes(8), 'source_ep': source_ep, 'dest_ep': dest_ep,
+                'cluster': cluster, 'profile': profile, 'broadcast': False, 'payload': payload}
+
+    def run(self):
+        sim.clock.now = self.start
+        machine.ADC.sources['D3'] = self.read_adc
+        xbee.receive = self.receive
+        # the firmware's trace hooks collect the replayed motor direction changes
+        trace.recording = True
+        trace.sample = lambda value, threshold: None
+        trace.frame = lambda received_msg: None
+        trace.motor = lambda direction: self.replayed_motor.append((sim.clock.now, direction))
+        try:
+            # as TRV.run: a frame can leave work (e.g. a PresentValue write's move) for Valve.update to start
+            while (self.frame_index < len(self.frames)) or (self.valve.pending_position is not None):
+                if self.frame_index < len(self.frames):
+                    sim.clock.now = max(sim.clock.now, self.frames[self.frame_index][0])
+                self.trv.process_msg()
+                self.trv.thermostat.update()
+                self.valve.update()
+        except EndOfTrace:
+            pass
+        trace.recording = False
+
+    def report(self):
+        recorded = [direction for ticks, direction in self.recorded_motor]
+        replayed = [direction for ticks, direction in self.replayed_motor]
+        print('trace: %i ms, %i samples, %i frames' % (self.end - self.start, len(self.samples), len(self.frames)))
+        print('replayed: %i samples, %i frames, rev counter %i, position %i' % (
+            self.sample_index, self.frame_index, self.valve.valve_sensor.rev_counter, self.valve.position))
+        print('motor direction changes: %i recorded, %i replayed' % (len(recorded), len(replayed)))
+        for index in range(min(len(recorded), len(replayed))):
+            if recorded[index] != replayed[index]:
+                print('first difference at change %i: recorded %i at %i ms, replayed %i at %i ms' % (
+                    index, recorded[index], self.recorded_motor[index][0], replayed[index],
+                    self.replayed_motor[index][0]))
+                return False
+        if len(recorded) != len(replayed):
+            return False
+        skew = [abs(a[0] - b[0]) for a, b in zip(self.recorded_motor, self.replayed_motor)]
+        print('largest timing difference: %i ms' % max(skew or [0]))
+        return True
+
+
+def main(path, profile):
+    with open(path, 'rb') as source:
+        replay = Replay(source.read())
+    started = host_time.perf_counter()
+    if profile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.runcall(replay.run)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+    else:
+        replay.run()
+    elapsed = host_time.perf_counter() - started
+    matched = replay.report()
+    print('replay took %.3f s, %.0fx real time' % (elapsed, (replay.end - replay.start) / 1000 / max(elapsed, 1e-6)))
+    return matched
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: replay.py <trace.bin> [--profile]')
+        sys.exit(2)
+    sys.exit(0 if main(sys.argv[1], '--profile' in sys.argv[2:]) else 1)
@@ -0,0 +1,69 @@
+# Host simulator: runs the device modules under CPython. The MicroPython and XBee only modules (machine, xbee, uio,
+# uos, uhashlib, ubinascii) are replaced by the stand-ins in this directory, and time gets the MicroPython ticks
+# functions on a virtual millisecond clock that only moves when the simulation moves it, so runs are deterministic.
+#
+#     import sim
+#     sim.install()
+#     import ZHA_comms
+import builtins
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+
+class Clock:
+    now = 0
+
+    def advance(self, ms):
+        self.now += int(ms)
+
+
+clock = Clock()
+
+
+def ticks_ms():
+    return clock.now
+
+
+def ticks_diff(ticks1, ticks2):
+    return ticks1 - ticks2
+
+
+def ticks_add(ticks, delta):
+    return ticks + delta
+
+
+def sleep_ms(ms):
+    clock.advance(ms)
+
+
+def sleep(seconds):
+    clock.advance(seconds * 1000)
+
+
+class MicroPythonBytearray(bytearray):
+    # MicroPython accepts a str where CPython needs an encoding, and the firmware relies on it
+    def __init__(self, source=b'', *args):
+        if isinstance(source, str):
+            source = source.encode()
+        super().__init__(source, *args)
+
+    def extend(self, values):
+        if isinstance(values, str):
+            values = values.encode()
+        super().extend(values)
+
+
+def install():
+    for path in (ROOT, HERE):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    time.ticks_ms = ticks_ms
+    time.ticks_diff = ticks_diff
+    time.ticks_add = ticks_add
+    time.sleep_ms = sleep_ms
+    time.sleep = sleep
+    builtins.bytearray = MicroPythonBytearray
@@ -0,0 +1,2 @@
+# ubinascii stand-in for the host simulator
+from binascii import hexlify, unhexlify
@@ -0,0 +1,2 @@
+# uhashlib stand-in for the host simulator
+from hashlib import sha256
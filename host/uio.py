@@ -0,0 +1,2 @@
+# uio stand-in for the host simulator
+from io import open
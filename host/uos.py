@@ -0,0 +1,2 @@
+# uos stand-in for the host simulator
+from os import listdir, remove, rename, stat
@@ -0,0 +1,47 @@
+# xbee stand-in for the host simulator: AT command values are kept in a dictionary, received frames are queued with
+# deliver() and every transmitted frame is passed to the callables in peers (e.g. a stand-in OTA server)
+import sim
+
+ADDR_COORDINATOR = b'\x00\x00\x00\x00\x00\x00\x00\x00'
+ADDR_BROADCAST = b'\x00\x00\x00\x00\x00\x00\xff\xff'
+
+at = {'AI': 0, 'MY': 0x1234, 'AV': 2, '%V': 3300, 'TP': 21, 'DB': 60, 'SM': 6, 'SH': 0x0013A200, 'SL': 0x41F2DE9F}
+received = []
+transmitted = []
+peers = []
+
+
+def atcmd(cmd, value=None):
+    if value is None:
+        return at.get(cmd, 0)
+    at[cmd] = value
+
+
+def receive():
+    if received:
+        return received.pop(0)
+    return None
+
+
+def deliver(payload, cluster, source_ep, dest_ep, profile=0x0104, sender_nwk=0x0000, sender_eui64=bytes(8),
+            broadcast=False):
+    received.append({'sender_nwk': sender_nwk, 'sender_eui64': sender_eui64, 'source_ep': source_ep,
+                     'dest_ep': dest_ep, 'cluster': cluster, 'profile': profile, 'broadcast': broadcast,
+                     'payload': bytes(payload)})
+
+
+def transmit(dest, payload, source_ep=0xe8, dest_ep=0xe8, cluster=0x0011, profile=0xc105, bcast_radius=0,
+             tx_options=0):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    frame = {'dest': dest, 'payload': bytes(payload), 'source_ep': source_ep, 'dest_ep': dest_ep, 'cluster': cluster,
+             'profile': profile}
+    transmitted.append(frame)
+    for peer in peers:
+        peer(frame)
+
+
+class XBee:
+    def sleep_now(self, timeout_ms, pin_wake=False):
+        sim.clock.advance(timeout_ms)
+        return timeout_ms
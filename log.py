@@ -0,0 +1,59 @@
+# Leveled logging facade for the frame handling and valve motion hot paths.
+# A message is only formatted if its level is enabled for the module that logs it:
+#     log.debug('valve', 'rev counter: %s', rev_counter)
+# Debug messages, and anything that is expensive to build before a call, are wrapped in `if __debug__:`, which is
+# compiled out of production builds (mpy-cross -O1). A call outside such a block is still evaluated there.
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+
+level = INFO  # level for modules without their own switch
+levels = {}  # per-module levels, e.g. {'valve': DEBUG, 'comms': OFF}
+sink = None  # called with each line instead of printing it, e.g. TRV.log to route to the log file
+
+
+def enabled(module, lvl):
+    return lvl >= levels.get(module, level)
+
+
+def set_level(lvl, module=None):
+    global level
+    if module is None:
+        level = lvl
+    else:
+        levels[module] = lvl
+
+
+def route(destination):
+    global sink
+    sink = destination
+
+
+def emit(module, lvl, fmt, args):
+    if lvl < levels.get(module, level):
+        return
+    if args:
+        fmt = fmt % args
+    if sink is None:
+        print(fmt)
+    else:
+        sink('%s: %s' % (module, fmt))
+
+
+def debug(module, fmt, *args):
+    emit(module, DEBUG, fmt, args)
+
+
+def info(module, fmt, *args):
+    emit(module, INFO, fmt, args)
+
+
+def warning(module, fmt, *args):
+    emit(module, WARNING, fmt, args)
+
+
+def error(module, fmt, *args):
+    emit(module, ERROR, fmt, args)
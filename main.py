@@ -1,6 +1,23 @@
+import gc
+gc.collect()
+heap_free = gc.mem_free()
+
+import ota
+ota.finish_swap()  # before importing any module an interrupted upgrade was replacing
+
+# 'lean' imports the maintenance handlers (diagnostics, log dump, AT passthrough, printing) only when they are used,
+# 'full' imports them at boot and keeps them
+PROFILE = 'lean'
+
 import ZHA_comms
 import valve
+import thermostat
+import history
+import power
+import groups
 import uos
+if PROFILE == 'full':
+    import maintenance
 
 print(" +--------------------------------------------+")
 print(" | XBee MicroPython Radiator Valve Controller |")
@@ -9,5 +26,14 @@ print(" +--------------------------------------------+\n")
 trv = ZHA_comms.TRV()
 valve = valve.Valve(trv)
 trv.valve = valve
+trv.thermostat = thermostat.Thermostat(trv, valve)
+trv.ota = ota.Ota(trv)
+trv.history = history.History(trv)
+trv.power = power.Power(trv)
+trv.groups = groups.Groups(trv)
+trv.keep_optional = PROFILE == 'full'
+gc.collect()
+trv.boot_heap = (heap_free - gc.mem_free(), gc.mem_free())
+print(" %s profile: %i bytes of heap used, %i free\n" % (PROFILE, trv.boot_heap[0], trv.boot_heap[1]))
 trv.initialise()
 trv.run()
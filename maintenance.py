@@ -0,0 +1,127 @@
+import struct
+import uio
+import uos
+from sys import stdout
+import xbee
+import log
+import energy
+import ZHA_comms
+
+# Rarely used handlers, imported on first use by TRV.optional and unloaded again when they have been idle: the
+# diagnostics endpoints and cluster, the log dump, AT command passthrough and the printing endpoint.
+MAX_REPLY = 73  # bytes in an AT batch reply frame, so it fits an unfragmented frame (as history.MAX_RESPONSE)
+
+
+# 'analogue output' cluster, diagnostics endpoints
+def read_battery_voltage(trv):
+    return ZHA_comms.analogue_records(b'battery_voltage', trv.battery_voltage_mV())
+
+
+def read_valve_period(trv):
+    return ZHA_comms.analogue_records(b'valve_period', trv.valve.valve_sensor.period_filtered)
+
+
+def read_charge_used(trv):
+    return ZHA_comms.analogue_records(b'charge_used_mAh', energy.charge_used())
+
+
+# 'diagnostics' cluster, activity counters behind the charge used estimate (manufacturer range attribute IDs)
+def read_diagnostics(trv):
+    counters = energy.counters
+    attribute_record = ZHA_comms.attribute_record
+    return (attribute_record(0x5000, 0x23, 'I', counters['motor_open_ms'])
+            + attribute_record(0x5001, 0x23, 'I', counters['motor_close_ms'])
+            + attribute_record(0x5002, 0x23, 'I', counters['stall_ms'])
+            + attribute_record(0x5003, 0x23, 'I', counters['transmits'])
+            + attribute_record(0x5004, 0x23, 'I', counters['bytes_sent'])
+            + attribute_record(0x5005, 0x23, 'I', counters['receives'])
+            + attribute_record(0x5006, 0x23, 'I', counters['awake_ms'] // 1000)  # seconds
+            + attribute_record(0x5007, 0x23, 'I', counters['asleep_ms'] // 1000)  # seconds
+            + attribute_record(0x5008, 0x23, 'I', int(energy.charge_used() * 1000))  # uAh
+            + attribute_record(0x5009, 0x21, 'H', trv.valve.last_move_speed)  # % of the learned travel rate
+            + attribute_record(0x500a, 0x20, 'B', trv.valve.calibration_confidence())  # %
+            + attribute_record(0x500b, 0x23, 'I', trv.boot_heap[0])  # bytes used by the firmware at boot
+            + attribute_record(0x500c, 0x23, 'I', trv.boot_heap[1])  # bytes free after boot
+            + attribute_record(0x500d, 0x23, 'I', trv.valve.homing_time)  # ms the last homing took
+            + attribute_record(0x500e, 0x29, 'h', trv.valve.homing_margin[0])  # revs of slow approach, open end-stop
+            + attribute_record(0x500f, 0x29, 'h', trv.valve.homing_margin[1]))  # revs of slow approach, closed
+
+
+# digi data endpoint
+def at_command(trv):
+    cmd = chr(trv.data[1]) + chr(trv.data[2])
+    if len(trv.data) == 3:
+        rsp = xbee.atcmd(cmd)
+    else:
+        rsp = xbee.atcmd(cmd, trv.data[3])
+    log.info('comms', '%s: %s', cmd, rsp)
+
+
+def at_batch(trv, sender):
+    # Batch of AT commands: flags (bit 0: apply changes, bit 1: write to flash), then for each command its two
+    # characters, value length (0 to query) and value (raw parameter bytes, as in an API frame). They run in
+    # order and the results go back to the sender: 'A', then for each command its two characters, status (0 = ok,
+    # 1 = error), value length and value. Results that don't fit in MAX_REPLY bytes follow in further 'A' frames.
+    payload = bytes(trv.data)
+    commands = []
+    index = 3
+    while index + 3 <= len(payload):
+        commands.append((payload[index:index + 2], payload[index + 3:index + 3 + payload[index + 2]]))
+        index += 3 + payload[index + 2]
+    if len(payload) > 2:
+        if payload[2] & 0x01:
+            commands.append((b'AC', b''))
+        if payload[2] & 0x02:
+            commands.append((b'WR', b''))
+    results = b'A'
+    for cmd, value in commands:
+        try:
+            # a command that isn't ASCII raises UnicodeError, a ValueError
+            rsp = xbee.atcmd(cmd.decode(), value) if value else xbee.atcmd(cmd.decode())
+            status = 0x00
+        except (OSError, ValueError, TypeError):
+            rsp = None
+            status = 0x01
+        if rsp is None:
+            rsp = b''
+        elif isinstance(rsp, int):
+            rsp = struct.pack('>I', rsp)
+            while (len(rsp) > 1) and (rsp[0] == 0):
+                rsp = rsp[1:]  # as few bytes as the value needs, like an API frame
+        elif isinstance(rsp, str):
+            rsp = rsp.encode()
+        log.info('comms', '%s: %s', cmd, rsp)
+        rsp = rsp[:MAX_REPLY - 5]  # only a value too long for any frame is cut short
+        result = cmd + struct.pack('BB', status, len(rsp)) + rsp
+        if len(results) + len(result) > MAX_REPLY:
+            trv.msg['payload'] = results
+            trv.send(sender)
+            results = b'A'
+        results += result
+    trv.msg['payload'] = results
+    trv.send(sender)
+
+
+def log_dump(trv):
+    sink = log.sink
+    log.route(None)  # the log file is closed while it is read
+    trv.logger.close()
+    with uio.open(ZHA_comms.LOG_FILE) as logger:
+        while True:
+            line = logger.readline(74)
+            if not line:
+                break
+            print(line, end="")
+            trv.send_broadcast_digi_data(line)
+    print("log file read")
+    uos.remove(ZHA_comms.LOG_FILE)
+    trv.logger = uio.open(ZHA_comms.LOG_FILE, mode="a")
+    trv.log('log file created')
+    log.route(sink)
+
+
+# endpoint for printing
+def print_frame(received_msg):
+    print("%s" % received_msg[
+        'payload'])  # this does not go to the serial terminal it goes to the MicroPython REPL, XCTU has to be set to REPL mode [4] to display the output
+    stdout.write("[serial out] %s" % received_msg['payload'])  # nothing appears on the serial port
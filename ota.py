@@ -0,0 +1,319 @@
+import struct
+import time
+import uio
+import uos
+import uhashlib
+import machine
+import log
+
+OTA_CLUSTER = 0x0019
+MANUFACTURER_CODE = 0x1234  # no registered manufacturer code, the OTA server's image has to use the same
+IMAGE_TYPE = 0x0001
+DEFAULT_VERSION = 0x00000001  # file version of a device that has never been upgraded
+VERSION_FILE = 'ota.version'
+STAGING_FILE = 'ota.bin'
+SWAP_FILE = 'ota.swap'
+
+# Zigbee OTA file: header, then sub-elements of tag (2 bytes), length (4 bytes), data
+MAGIC = 0x0BEEF11E
+HEADER_FORMAT = '<IHHHHHIH32sI'  # magic, header version, header length, field control, manufacturer code, image type,
+#                                  file version, stack version, header string, total image size
+HEADER_LENGTH = 56
+TAG_FILE = 0xf000  # manufacturer specific: name length (1 byte), name, file contents
+TAG_DIGEST = 0xf001  # manufacturer specific: sha256 of everything before it, has to be the last sub-element
+CHUNK = 64  # bytes read from flash at a time while checking and unpacking the image
+
+# ZCL status
+SUCCESS = 0x00
+ABORT = 0x95
+INVALID_IMAGE = 0x96
+WAIT_FOR_DATA = 0x97
+NO_IMAGE_AVAILABLE = 0x98
+
+# client states
+IDLE = 0
+QUERYING = 1
+DOWNLOADING = 2
+WAITING_UPGRADE = 3
+
+
+def current_version():
+    try:
+        with uio.open(VERSION_FILE) as version:
+            return int(version.read())
+    except (OSError, ValueError):
+        return DEFAULT_VERSION
+
+
+def finish_swap():
+    # Completes a swap that was interrupted by a reset. The unpacked files are renamed over the old ones only once
+    # they have all been written, and SWAP_FILE lists them until every rename is done.
+    try:
+        with uio.open(SWAP_FILE) as swap:
+            names = swap.read().split()
+    except OSError:
+        return
+    for name in names:
+        try:
+            uos.rename(name + '.new', name)
+        except OSError:
+            pass  # already renamed before the reset
+        try:
+            uos.remove(name[:-3] + '.mpy')  # don't let a stale compiled module shadow the new source
+        except OSError:
+            pass
+    uos.remove(SWAP_FILE)
+
+
+def copy(source, name, length):
+    with uio.open(name, mode='wb') as destination:
+        while length > 0:
+            chunk = source.read(min(CHUNK, length))
+            if not chunk:
+                raise ValueError('truncated file element')
+            destination.write(chunk)
+            length -= len(chunk)
+
+
+class Ota:
+    state = IDLE
+    sequence = 0
+    server_ep = 0x01
+    image_version = 0
+    image_size = 0
+    header_length = HEADER_LENGTH
+    offset = 0
+    staging = None
+    block_size = 32
+    BLOCK_SIZE_MIN = 16
+    BLOCK_SIZE_MAX = 48  # image block response overhead leaves about this much in one unfragmented frame
+    request_interval = 500
+    REQUEST_INTERVAL_MIN = 100  # milliseconds between block requests on a good link
+    REQUEST_INTERVAL_MAX = 10000
+    GOOD_LINK_RSSI = 75  # 'DB' is the last hop RSSI in -dBm
+    RESPONSE_TIMEOUT = 3000
+    MAX_RETRIES = 10
+    QUERY_INTERVAL = 86400000  # query for a new image once a day, as well as when the server notifies one
+    QUERY_RETRY_INTERVAL = 60000  # after a query went unanswered
+    UPGRADE_END_TIMEOUT = 60000  # milliseconds before an unanswered upgrade end request is sent again
+    retries = 0
+    awaiting = False
+    requested_at = 0
+    next_request = 0
+    next_query = 0
+    apply_at = None
+
+    def __init__(self, trv):
+        self.trv = trv
+        self.next_query = time.ticks_add(time.ticks_ms(), self.QUERY_INTERVAL)
+
+    def update(self):
+        now = time.ticks_ms()
+        if self.state == IDLE:
+            if time.ticks_diff(now, self.next_query) >= 0:
+                self.query()
+        elif self.state == QUERYING:
+            if time.ticks_diff(now, self.requested_at) > self.RESPONSE_TIMEOUT:
+                log.warning('ota', 'no query next image response')
+                self.next_query = time.ticks_add(now, self.QUERY_RETRY_INTERVAL)
+                self.state = IDLE
+        elif self.state == DOWNLOADING:
+            if self.awaiting:
+                if time.ticks_diff(now, self.requested_at) > self.RESPONSE_TIMEOUT:
+                    self.awaiting = False
+                    self.retries += 1
+                    if self.retries > self.MAX_RETRIES:
+                        self.cancel(ABORT)
+                        return
+                    # poor link: smaller blocks, asked for less often
+                    self.block_size = max(self.block_size // 2, self.BLOCK_SIZE_MIN)
+                    self.request_interval = min(self.request_interval * 2, self.REQUEST_INTERVAL_MAX)
+                    self.next_request = now
+            elif time.ticks_diff(now, self.next_request) >= 0:
+                self.request_block()
+        elif self.state == WAITING_UPGRADE:
+            if self.apply_at is not None:
+                if time.ticks_diff(now, self.apply_at) >= 0:
+                    self.apply()
+            elif time.ticks_diff(now, self.requested_at) > self.UPGRADE_END_TIMEOUT:
+                # the upgrade end response was lost (or the server said to wait and didn't come back)
+                self.retries += 1
+                if self.retries > self.MAX_RETRIES:
+                    log.warning('ota', 'no upgrade end response')
+                    self.cancel(None)
+                    return
+                self.end(SUCCESS)
+
+    def handle(self, data, server_ep):
+        self.server_ep = server_ep
+        command = data[2]
+        payload = bytes(data[3:])
+        # image notify
+        if command == 0x00:
+            if self.state == IDLE:
+                self.query()
+        # query next image response
+        elif command == 0x02:
+            if self.state != QUERYING:
+                return
+            if payload[0] != SUCCESS:
+                log.info('ota', 'no image available')
+                self.state = IDLE
+                return
+            manufacturer, image_type, version, size = struct.unpack('<HHII', payload[1:13])
+            if (manufacturer != MANUFACTURER_CODE) or (image_type != IMAGE_TYPE) or (version <= current_version()):
+                self.state = IDLE
+                return
+            log.info('ota', 'downloading image %08x, %i bytes', version, size)
+            self.image_version = version
+            self.image_size = size
+            self.offset = 0
+            self.retries = 0
+            self.awaiting = False
+            self.next_request = time.ticks_ms()
+            self.staging = uio.open(STAGING_FILE, mode='wb')
+            self.state = DOWNLOADING
+        # image block response
+        elif command == 0x05:
+            if self.state != DOWNLOADING:
+                return
+            if payload[0] == SUCCESS:
+                version, offset, size = struct.unpack('<IIB', payload[5:14])
+                if (version != self.image_version) or (offset != self.offset) or (size == 0):
+                    return  # a late response to a request that has already been retried
+                # written straight to flash, so memory use doesn't depend on the image size
+                self.staging.write(payload[14:14 + size])
+                self.offset += size
+                self.awaiting = False
+                self.retries = 0
+                self.adapt()
+                if self.offset >= self.image_size:
+                    self.staging.close()
+                    self.staging = None
+                    self.end(SUCCESS if self.verify() else INVALID_IMAGE)
+            elif payload[0] == WAIT_FOR_DATA:
+                current_time, request_time = struct.unpack('<II', payload[1:9])
+                self.awaiting = False
+                self.next_request = time.ticks_add(time.ticks_ms(), max(request_time - current_time, 1) * 1000)
+            elif payload[0] == ABORT:
+                self.cancel(None)
+        # upgrade end response
+        elif command == 0x07:
+            if self.state != WAITING_UPGRADE:
+                return
+            current_time, upgrade_time = struct.unpack('<II', payload[8:16])
+            if upgrade_time == 0xffffffff:
+                self.requested_at = time.ticks_ms()  # wait for the server to send another upgrade end response
+                return
+            delay = max(upgrade_time - current_time, 0) if upgrade_time else 0
+            self.apply_at = time.ticks_add(time.ticks_ms(), delay * 1000)
+
+    def adapt(self):
+        if self.trv.xbee.atcmd('DB') <= self.GOOD_LINK_RSSI:
+            self.block_size = min(self.block_size + 8, self.BLOCK_SIZE_MAX)
+            self.request_interval = max(self.request_interval // 2, self.REQUEST_INTERVAL_MIN)
+        else:
+            self.block_size = max(self.block_size - 8, self.BLOCK_SIZE_MIN)
+            self.request_interval = min(self.request_interval * 2, self.REQUEST_INTERVAL_MAX)
+        self.next_request = time.ticks_add(time.ticks_ms(), self.request_interval)
+
+    def query(self):
+        self.requested_at = time.ticks_ms()
+        self.next_query = time.ticks_add(self.requested_at, self.QUERY_INTERVAL)
+        self.state = QUERYING
+        # field control, manufacturer code, image type, current file version
+        self.send(0x01, struct.pack('<BHHI', 0x00, MANUFACTURER_CODE, IMAGE_TYPE, current_version()))
+
+    def request_block(self):
+        self.awaiting = True
+        self.requested_at = time.ticks_ms()
+        size = min(self.block_size, self.image_size - self.offset)
+        # field control, manufacturer code, image type, file version, file offset, maximum data size
+        self.send(0x03, struct.pack('<BHHIIB', 0x00, MANUFACTURER_CODE, IMAGE_TYPE, self.image_version, self.offset,
+                                    size))
+
+    def end(self, status):
+        log.info('ota', 'download complete, status %02x', status)
+        # status, manufacturer code, image type, file version
+        self.send(0x06, struct.pack('<BHHI', status, MANUFACTURER_CODE, IMAGE_TYPE, self.image_version))
+        if status == SUCCESS:
+            if self.state != WAITING_UPGRADE:
+                self.retries = 0
+            self.apply_at = None
+            self.requested_at = time.ticks_ms()
+            self.state = WAITING_UPGRADE
+        else:
+            self.cancel(None)
+
+    def cancel(self, status):
+        if status is not None:
+            self.send(0x06, struct.pack('<BHHI', status, MANUFACTURER_CODE, IMAGE_TYPE, self.image_version))
+        log.warning('ota', 'download cancelled')
+        if self.staging is not None:
+            self.staging.close()
+            self.staging = None
+        try:
+            uos.remove(STAGING_FILE)
+        except OSError:
+            pass
+        self.state = IDLE
+
+    def send(self, command, payload):
+        self.sequence = (self.sequence + 1) & 0xff
+        self.trv.msg['source_ep'] = 0x55
+        self.trv.msg['dest_ep'] = self.server_ep
+        self.trv.msg['cluster'] = OTA_CLUSTER
+        self.trv.msg['profile'] = 0x0104
+        # cluster specific, client to server
+        self.trv.msg['payload'] = struct.pack('BBB', 0x01, self.sequence, command) + payload
+        self.trv.send()
+
+    def elements(self, image):
+        # yields (tag, length) with the file positioned at the start of the element's data
+        position = self.header_length
+        while position + 6 <= self.image_size:
+            image.seek(position)
+            tag, length = struct.unpack('<HI', image.read(6))
+            yield tag, length
+            position += 6 + length
+
+    def verify(self):
+        try:
+            with uio.open(STAGING_FILE, mode='rb') as image:
+                header = struct.unpack(HEADER_FORMAT, image.read(HEADER_LENGTH))
+                self.header_length = header[2]  # longer if the header has optional fields
+                if (header[0] != MAGIC) or (header[4] != MANUFACTURER_CODE) or (header[5] != IMAGE_TYPE) or (
+                        header[6] != self.image_version) or (header[9] != self.image_size):
+                    return False
+                for tag, length in self.elements(image):
+                    if tag == TAG_DIGEST:
+                        digest_at = image.tell() - 6
+                        expected = image.read(32)
+                        image.seek(0)
+                        digest = uhashlib.sha256()
+                        remaining = digest_at
+                        while remaining > 0:
+                            chunk = image.read(min(CHUNK, remaining))
+                            digest.update(chunk)
+                            remaining -= len(chunk)
+                        return digest.digest() == expected
+        except (OSError, ValueError):
+            pass
+        return False
+
+    def apply(self):
+        log.info('ota', 'upgrading to %08x', self.image_version)
+        names = []
+        with uio.open(STAGING_FILE, mode='rb') as image:
+            for tag, length in self.elements(image):
+                if tag == TAG_FILE:
+                    name = image.read(image.read(1)[0]).decode()
+                    copy(image, name + '.new', length - 1 - len(name))
+                    names.append(name)
+        with uio.open(SWAP_FILE, mode='w') as swap:
+            swap.write(' '.join(names))
+        finish_swap()
+        with uio.open(VERSION_FILE, mode='w') as version:
+            version.write('%i' % self.image_version)
+        uos.remove(STAGING_FILE)
+        machine.reset()
@@ -0,0 +1,64 @@
+import time
+import log
+import energy
+import ota
+
+# Sleeps the module between activities. The next deadline is the earliest of the next report, thermostat update,
+# history sample, OTA query and boot homing, and the module sleeps until then, waking early on the pin. The sleep is
+# capped at MAX_SLEEP because the parent only buffers frames for a sleeping end device for a limited time (about 30 s),
+# and the module stays awake while the valve has work to do, an OTA transfer is running or a frame arrived recently.
+# The binary input 'awake' attribute is 1 while the module is staying awake and 0 while it is duty cycling.
+MIN_SLEEP = 200  # milliseconds, shorter gaps aren't worth sleeping for
+MAX_SLEEP = 20000
+STAY_AWAKE = 2000  # milliseconds after a received frame, for the rest of an exchange (e.g. an interview)
+
+
+class Power:
+    asleep_for = 0  # milliseconds the module last slept for
+
+    def __init__(self, trv):
+        self.trv = trv
+
+    def busy(self, now):
+        valve = self.trv.valve
+        if valve.travelling or (valve.pending_position is not None) or valve.home_due:
+            return True
+        if self.trv.ota.state != ota.IDLE:
+            return True
+        return time.ticks_diff(now, self.trv.last_received) < STAY_AWAKE
+
+    def next_deadline(self, now):
+        deadlines = [self.trv.next_report, self.trv.history.next_sample, self.trv.ota.next_query,
+                     time.ticks_add(now, MAX_SLEEP)]
+        if self.trv.home_at is not None:
+            deadlines.append(self.trv.home_at)
+        thermostat = self.trv.thermostat
+        if thermostat.local_control():
+            if thermostat.last_update is None:
+                return now
+            deadlines.append(time.ticks_add(thermostat.last_update, thermostat.SAMPLE_PERIOD))
+        deadline = deadlines[0]
+        for candidate in deadlines[1:]:
+            if time.ticks_diff(candidate, deadline) < 0:
+                deadline = candidate
+        return deadline
+
+    def update(self):
+        # called from the main loop, after everything that was due has been done
+        now = time.ticks_ms()
+        if self.busy(now):
+            self.set_awake(1)
+            return
+        duration = time.ticks_diff(self.next_deadline(now), now)
+        if duration < MIN_SLEEP:
+            return
+        self.set_awake(0)
+        if __debug__:
+            log.debug('comms', 'sleeping for %i ms', duration)
+        self.asleep_for = self.trv.xbee.XBee().sleep_now(duration, pin_wake=True)
+        energy.asleep(self.asleep_for)
+
+    def set_awake(self, awake):
+        if self.trv.awake_flag != awake:
+            self.trv.awake_flag = awake
+            self.trv.report_attribute(0x000f, 0x55)
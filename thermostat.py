@@ -0,0 +1,77 @@
+import time
+import log
+
+# ZCL thermostat cluster (0x0201) system modes
+SYSTEM_MODE_OFF = 0x00
+SYSTEM_MODE_HEAT = 0x04
+
+
+class Thermostat:
+    setpoint = 2000  # occupied heating setpoint, 100ths of a degree like the ZCL attribute
+    MIN_SETPOINT = 500
+    MAX_SETPOINT = 3000
+    system_mode = SYSTEM_MODE_OFF
+    heating_demand = 0  # % open, reported as PIHeatingDemand
+    KP = 30  # % open per degree of error
+    KI = 0.5  # % open per degree minute of accumulated error
+    SAMPLE_PERIOD = 60000  # milliseconds between controller updates
+    MAX_STEP = 20  # rate limit, most the valve opening can change (%) per update
+    DEADBAND = 5  # smaller changes (%) are not worth running the motor for
+    integral = 0
+    last_update = None
+
+    def __init__(self, trv, valve):
+        self.trv = trv
+        self.valve = valve
+
+    def local_control(self):
+        return self.system_mode == SYSTEM_MODE_HEAT
+
+    def set_setpoint(self, setpoint):
+        if (setpoint < self.MIN_SETPOINT) or (setpoint > self.MAX_SETPOINT):
+            return False
+        self.setpoint = setpoint
+        self.last_update = None  # act on the new setpoint at the next update
+        return True
+
+    def set_system_mode(self, mode):
+        if mode not in (SYSTEM_MODE_OFF, SYSTEM_MODE_HEAT):
+            return False
+        if (mode == SYSTEM_MODE_HEAT) and not self.local_control():
+            # start from where the valve is, so switching to local control doesn't move it on its own
+            self.heating_demand = self.valve.percentage_open()
+            self.integral = 0
+            self.last_update = None
+        self.system_mode = mode
+        log.info('thermostat', 'system mode: %02x', mode)
+        return True
+
+    def update(self):
+        if not self.local_control():
+            return
+        now = time.ticks_ms()
+        if self.last_update is None:
+            minutes = 0
+        else:
+            elapsed = time.ticks_diff(now, self.last_update)
+            if elapsed < self.SAMPLE_PERIOD:
+                return
+            minutes = elapsed / 60000
+        self.last_update = now
+        error = (self.setpoint - self.trv.get_temperature()) / 100
+        output = self.KP * error + self.KI * (self.integral + error * minutes)
+        # only integrate while the output isn't saturated, so the integral can't wind up with the valve fully open
+        if 0 < output < 100:
+            self.integral += error * minutes
+        output = min(max(output, 0), 100)
+        step = min(max(output - self.heating_demand, -self.MAX_STEP), self.MAX_STEP)
+        demand = int(self.heating_demand + step)
+        if (abs(demand - self.heating_demand) < self.DEADBAND) and (demand not in (0, 100)):
+            return
+        if demand == self.heating_demand:
+            return
+        log.info('thermostat', 'setpoint %i/100 C, demand %i%%', self.setpoint, demand)
+        self.heating_demand = demand
+        self.trv.on_off_attributes['OnOff'] = demand > 0
+        self.valve.set_percentage_open(demand)
+        self.trv.report_attribute(0x0201, 0x55)
@@ -0,0 +1,187 @@
+import struct
+import time
+
+# Record/replay trace of received frames, ADC samples and motor direction changes, written to a buffer that is
+# allocated once when recording starts, so recording never allocates. Each record is its type (1 byte), the ms since
+# the previous record (1 byte, 255 = followed by the absolute ticks_ms, 4 bytes) and then:
+#   SNAPSHOT: rev counter, position, closed position, peek period, filtered period, threshold, direction, homed,
+#             drift rate, revs since calibration, slow period, battery mV, learned rate count, then for each learned
+#             travel rate its direction, battery band and rate
+#   FRAME: cluster, source ep, destination ep, profile, sender network address, payload length, payload
+#   SAMPLE: ADC reading, count of readings skipped before it
+#   MOTOR: direction
+# Only the readings on the other side of the threshold from the last recorded one are kept, and the skipped readings
+# in between (all on the same side as it) are counted, so a trace holds edges rather than every sample of a move. The
+# last skipped reading is recorded before a motor or frame record, so the reading a decision was taken on is kept.
+# host/replay.py feeds a dumped trace back through Sensor, Valve and TRV.
+SNAPSHOT = 0x53  # 'S'
+FRAME = 0x46  # 'F'
+SAMPLE = 0x41  # 'A'
+MOTOR = 0x4d  # 'M'
+SNAPSHOT_FORMAT = '<hhhHHHbBfIHHB'
+RATE_FORMAT = '<bBf'
+FRAME_FORMAT = '<HBBHHB'
+DEFAULT_SIZE = 4096
+DUMP_CHUNK = 64
+
+recording = False
+full = False
+buffer = None
+length = 0
+last_tick = 0
+last_sample = None  # the last recorded ADC reading
+skipped = 0  # readings since then that weren't recorded
+pending = 0  # the last of them
+
+
+def start(valve, size=DEFAULT_SIZE):
+    global buffer, length, recording, full, last_sample, skipped
+    if (buffer is None) or (len(buffer) != size):
+        buffer = None
+        buffer = bytearray(size)
+    length = 0
+    full = False
+    last_sample = None
+    skipped = 0
+    recording = True
+    sensor = valve.valve_sensor
+    rates = valve.rate.rates
+    offset = header(SNAPSHOT, struct.calcsize(SNAPSHOT_FORMAT) + len(rates) * struct.calcsize(RATE_FORMAT))
+    if offset < 0:
+        return  # the buffer is too small for even the snapshot, header() has stopped recording and set full
+    struct.pack_into(SNAPSHOT_FORMAT, buffer, offset, sensor.rev_counter, valve.position, valve.closed_position,
+                     int(sensor.peek_period), int(sensor.period_filtered), sensor.THRESHOLD, valve.motor.direction,
+                     valve.homing_complete, valve.drift_rate, int(valve.revs_since_calibration), valve.slow_period,
+                     valve.trv.battery_voltage_mV(), len(rates))
+    offset += struct.calcsize(SNAPSHOT_FORMAT)
+    for (direction, band), rate in rates.items():
+        struct.pack_into(RATE_FORMAT, buffer, offset, direction, band, rate)
+        offset += struct.calcsize(RATE_FORMAT)
+
+
+def stop():
+    global recording
+    if recording:
+        flush()
+    recording = False
+
+
+def release():
+    # give the buffer back to the heap
+    global buffer, length, recording
+    recording = False
+    buffer = None
+    length = 0
+
+
+def header(kind, size):
+    # writes a record header and returns where its data goes, or -1 once the buffer is full
+    global length, last_tick, recording, full
+    now = time.ticks_ms()
+    delta = time.ticks_diff(now, last_tick)
+    absolute = (length == 0) or (delta < 0) or (delta > 254)
+    offset = length + (6 if absolute else 2)
+    if offset + size > len(buffer):
+        recording = False
+        full = True
+        return -1
+    buffer[length] = kind
+    if absolute:
+        buffer[length + 1] = 255
+        struct.pack_into('<I', buffer, length + 2, now)
+    else:
+        buffer[length + 1] = delta
+    last_tick = now
+    length = offset + size
+    return offset
+
+
+def sample(value, threshold):
+    global skipped, pending
+    if (last_sample is not None) and ((value >= threshold) == (last_sample >= threshold)) and (skipped < 65535):
+        skipped += 1
+        pending = value
+    else:
+        record_sample(value)
+
+
+def flush():
+    # records the last skipped reading
+    global skipped
+    if skipped:
+        skipped -= 1
+        record_sample(pending)
+
+
+def record_sample(value):
+    global last_sample, skipped
+    offset = header(SAMPLE, 4)
+    if offset >= 0:
+        struct.pack_into('<HH', buffer, offset, value, skipped)
+    last_sample = value
+    skipped = 0
+
+
+def motor(direction):
+    flush()
+    offset = header(MOTOR, 1)
+    if offset >= 0:
+        struct.pack_into('<b', buffer, offset, direction)
+
+
+def frame(received_msg):
+    flush()
+    payload = received_msg['payload'][:255]
+    offset = header(FRAME, struct.calcsize(FRAME_FORMAT) + len(payload))
+    if offset >= 0:
+        struct.pack_into(FRAME_FORMAT, buffer, offset, received_msg['cluster'], received_msg['source_ep'],
+                         received_msg['dest_ep'], received_msg['profile'], received_msg.get('sender_nwk') or 0,
+                         len(payload))
+        offset += struct.calcsize(FRAME_FORMAT)
+        for index in range(len(payload)):
+            buffer[offset + index] = payload[index]
+
+
+def dump(send):
+    # sends the trace in chunks of 'R', offset (2 bytes), data
+    stop()
+    for offset in range(0, length, DUMP_CHUNK):
+        send(b'R' + struct.pack('<H', offset) + buffer[offset:min(offset + DUMP_CHUNK, length)])
+
+
+def records(data):
+    # yields (ticks, type, values) from a trace, used by the host replayer
+    position = 0
+    now = 0
+    while position + 2 <= len(data):
+        kind = data[position]
+        delta = data[position + 1]
+        position += 2
+        if delta == 255:
+            now = struct.unpack_from('<I', data, position)[0]
+            position += 4
+        else:
+            now += delta
+        if kind == SNAPSHOT:
+            values = struct.unpack_from(SNAPSHOT_FORMAT, data, position)
+            position += struct.calcsize(SNAPSHOT_FORMAT)
+            rates = {}
+            for _ in range(values[-1]):
+                direction, band, rate = struct.unpack_from(RATE_FORMAT, data, position)
+                rates[(direction, band)] = rate
+                position += struct.calcsize(RATE_FORMAT)
+            values = values[:-1] + (rates,)
+        elif kind == FRAME:
+            values = struct.unpack_from(FRAME_FORMAT, data, position)
+            position += struct.calcsize(FRAME_FORMAT)
+            values = values + (bytes(data[position:position + values[5]]),)
+            position += values[5]
+        elif kind == SAMPLE:
+            values = struct.unpack_from('<HH', data, position)
+            position += 4
+        elif kind == MOTOR:
+            values = struct.unpack_from('<b', data, position)
+            position += 1
+        else:
+            return  # unused end of the buffer
+        yield now, kind, values
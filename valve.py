@@ -1,15 +1,52 @@
 from machine import Pin, ADC, PWM
 import time
+import log
+import energy
+import trace
 
 
 class Motor:
     motor_pin1 = Pin('D11', Pin.OUT)  # PWM(Pin('P1'))
     motor_pin2 = Pin('D1', Pin.OUT)  # , Pin.PULL_UP)
+    SLOW_DUTY = 880  # PWM duty of pin 1 away from full drive, 880 is the slowest before the motor won't turn
+    pwm = None  # pin 1 (P1 is D11) as PWM while the motor runs slowly
+    slow = False
     direction = 0
     moving = False
+    started = 0
+
+    def account(self, direction):
+        # motor run time per direction for the energy counters, and direction changes for the trace
+        if trace.recording and (direction != self.direction):
+            trace.motor(direction)
+        now = time.ticks_ms()
+        if self.moving:
+            energy.motor(self.direction, time.ticks_diff(now, self.started))
+        self.started = now
+
+    def drive_pin1(self, level, slow_duty=None):
+        # pin 1 is switched, or driven by PWM while the motor runs slowly
+        if self.slow and (slow_duty is not None):
+            if self.pwm is None:
+                self.pwm = PWM(Pin('P1'))
+            self.pwm.duty(slow_duty)
+            return
+        if self.pwm is not None:
+            self.pwm = None
+            self.motor_pin1 = Pin('D11', Pin.OUT)  # back to a switched output
+        self.motor_pin1.value(level)
+
+    def set_slow(self, slow):
+        # changes the speed of a running motor straight away
+        self.slow = slow
+        if self.direction == -1:
+            self.forwards()
+        elif self.direction == 1:
+            self.reverse()
 
     def forwards(self):
-        self.motor_pin1.on()  # duty(1023)
+        self.account(-1)
+        self.drive_pin1(1, 1023 - self.SLOW_DUTY)  # duty(1023)
         self.motor_pin2.off()
         self.direction = -1
         self.moving = True
@@ -17,7 +54,8 @@ class Motor:
         # Pin('D11', Pin.IN, Pin.PULL_DOWN)
 
     def reverse(self):
-        self.motor_pin1.off()  # duty(0) 880 is the slowest before the motor won't turn
+        self.account(1)
+        self.drive_pin1(0, self.SLOW_DUTY)  # duty(0) 880 is the slowest before the motor won't turn
         self.motor_pin2.on()
         self.direction = 1
         self.moving = True
@@ -25,7 +63,8 @@ class Motor:
         # Pin('D11', Pin.IN, Pin.PULL_UP)
 
     def stop_hard(self):
-        self.motor_pin1.on()
+        self.account(0)
+        self.drive_pin1(1)
         self.motor_pin2.on()
         self.direction = 0
         self.moving = False
@@ -33,7 +72,8 @@ class Motor:
         # Pin('D11', Pin.IN, Pin.PULL_UP)
 
     def stop_soft(self):
-        self.motor_pin1.off()  # duty(0)
+        self.account(0)
+        self.drive_pin1(0)  # duty(0)
         self.motor_pin2.off()
         self.direction = 0
         self.moving = False
@@ -60,6 +100,8 @@ class Sensor:
 
     def read(self):
         sensor_value = self.ADC.read()  # set xbee ref voltage (AT command 'AV') to VDD
+        if trace.recording:
+            trace.sample(sensor_value, self.THRESHOLD)
         if (sensor_value >= self.THRESHOLD) & (self.last_reading < self.THRESHOLD):
             # print(self.period)
             if (self.period > 10) and (self.period < self.peek_period):
@@ -90,12 +132,98 @@ class Sensor:
         self.THRESHOLD = value
 
 
+class TravelRate:
+    # Revolutions per second learned from completed moves, for each direction (as Motor.direction) and battery voltage
+    # band, so a move's duration can be predicted and a revolution that takes much longer than predicted is a stall.
+    DEFAULT_RATE = 14.0  # revolutions per second until a rate has been learned
+    BAND = 200  # mV of battery voltage per band
+    MIN_REVS = 10  # shorter moves are mostly motor start-up
+    WEIGHT = 0.25  # of each new measurement in the learned rate
+    STALL_FACTOR = 2.5  # times the expected revolution period
+    STALL_MIN = 150  # milliseconds
+    rates = None
+
+    def __init__(self):
+        self.rates = {}
+
+    def rate(self, direction, battery_mV):
+        band = battery_mV // self.BAND
+        if (direction, band) in self.rates:
+            return self.rates[(direction, band)]
+        # the nearest band learned in the same direction, the rate only changes slowly with voltage
+        rate = self.DEFAULT_RATE
+        nearest = None
+        for (learned_direction, learned_band), learned_rate in self.rates.items():
+            if (learned_direction == direction) and ((nearest is None) or (abs(learned_band - band) < nearest)):
+                nearest = abs(learned_band - band)
+                rate = learned_rate
+        return rate
+
+    def learned(self, direction):
+        for learned_direction, band in self.rates:
+            if learned_direction == direction:
+                return True
+        return False
+
+    def duration(self, revs, direction, battery_mV):
+        # expected milliseconds to travel revs
+        return int(abs(revs) * 1000 / self.rate(direction, battery_mV))
+
+    def stall_period(self, direction, battery_mV):
+        return max(int(self.STALL_FACTOR * 1000 / self.rate(direction, battery_mV)), self.STALL_MIN)
+
+    def learn(self, direction, battery_mV, revs, ms):
+        if (abs(revs) < self.MIN_REVS) or (ms <= 0):
+            return
+        key = (direction, battery_mV // self.BAND)
+        measured = abs(revs) * 1000 / ms
+        if key in self.rates:
+            self.rates[key] += self.WEIGHT * (measured - self.rates[key])
+        else:
+            self.rates[key] = measured
+
+
 class Valve:
     motor = Motor()
     valve_sensor = Sensor(motor)
     STALL_TIME = 200  # milliseconds
     closed_position = 0
     position = 0
+    pending_position = None  # latest target requested while travelling
+    REPLAN_REVS = 5  # revolutions between re-plans while travelling
+    RADIO_POLL_INTERVAL = 50  # milliseconds between radio polls while travelling
+    RADIO_SLICE = 20  # milliseconds handling a received frame is budgeted to take
+    RADIO_MAX_DEFER = 1000  # milliseconds the radio can go unpolled while travelling
+    last_radio_poll = 0
+    PROGRESS_INTERVAL = 5000  # milliseconds between progress reports while travelling
+    SLOW_MOVE = 150  # a move taking longer than this percentage of its expected duration is logged
+    rate = TravelRate()
+    battery_mV = 0  # measured at the start of each move, for the travel rate
+    eta = 0  # expected milliseconds until the valve reaches its target, 0 when it isn't moving
+    last_move_speed = 100  # expected duration of the last completed move as a percentage of the time it took
+    # Moves stay END_STOP_MARGIN short of the end-stops, so normal travel never reaches one. When the valve is opened
+    # and the drift that may have built up is large enough, it seeks the open end-stop to re-zero the counter, and a
+    # full home is only scheduled if that doesn't find the end-stop where expected. The closed end-stop (and so
+    # closed_position) is only measured by a full home.
+    END_STOP_MARGIN = 50  # revolutions the end-stops are beyond the travel from 0 to closed_position (see home_valve)
+    END_STOP_WINDOW = 10  # revolutions from an end-stop that a stall is taken as contact with it
+    SEEK_DRIFT = 5  # revolutions of estimated drift that make an opening move seek the open end-stop
+    MAX_DRIFT = 20  # revolutions of estimated drift that call for a full home
+    drift_rate = 0.01  # estimated revolutions miscounted per revolution travelled, learned from end-stop contacts
+    revs_since_calibration = 0
+    home_due = False
+    # Once the counter and closed_position are known, homing runs at full speed to within APPROACH_REVS (plus the
+    # drift that may have built up) of each end-stop and approaches it slowly from there, so the end-stop is met at
+    # low speed and the stall is caught within a fraction of a revolution.
+    APPROACH_REVS = 5
+    SLOW_STALL_FACTOR = 1.5  # times the slow revolution period
+    SLOW_STALL_MIN = 100  # milliseconds
+    SLOW_FIRST_STALL = 2000  # milliseconds, until a slow revolution period has been measured
+    slow_period = 0  # milliseconds per revolution at the slow approach speed, learned while homing
+    homing_time = 0  # milliseconds the last homing took
+    # revolutions of slow approach before the open and closed end-stops in the last homing, negative if an end-stop
+    # was met at full speed and 0 if its position wasn't known
+    homing_margin = (0, 0)
     travelling = False
     interupt = False
     homing_complete = False
@@ -130,37 +258,151 @@ class Valve:
 
     def demand(self):  # report attribute turned off for now
         if self.trv.on_off_attributes['OnOff']:
-            print('\nopen command')
-            self.position = 0
-            self.goto_revs()
+            log.info('valve', 'open command')
+            self.request_position(0)
         else:
-            print('\nclose command')
-            self.position = self.closed_position
-            self.goto_revs()
+            log.info('valve', 'close command')
+            self.request_position(self.closed_position)
+
+    def request_position(self, position):
+        if self.travelling:
+            # latest wins: only the most recent target is kept, goto_revs picks it up at the next safe point
+            if position == self.position:
+                self.pending_position = None
+            else:
+                self.pending_position = position
+            return
+        if (position == self.position) and (self.valve_sensor.rev_counter == position):
+            log.info('valve', 'valve already at desired position')
+            return
+        self.position = position
+        self.goto_revs()
+
+    def request_position_later(self, position):
+        # for a request made while handling a frame, which has to be answered before the valve moves
+        self.pending_position = position
 
     def home_valve(self):
-        print('homing')
-        self.open_valve()
-        self.valve_moving(3000)
-        print('reached end of travel')
+        log.info('valve', 'homing')
+        started = time.ticks_ms()
+        rehoming = self.homing_complete
+        target_closed = self.position >= self.closed_position  # the target of a re-home, see below
+        self.interupt = False  # a stale 'I' command would end the seeks before they start
+        open_margin = 0
+        closed_margin = 0
+        if rehoming:
+            open_margin = self.seek_end_stop(-1, self.valve_sensor.rev_counter + self.END_STOP_MARGIN,
+                                             int(self.drift()))
+        else:
+            # after a reset the counter isn't known, so the open end-stop could be anywhere
+            self.open_valve()
+            self.valve_moving(3000)
+        log.info('valve', 'reached end of travel')
+        if self.homing_complete:
+            self.learn_drift(self.valve_sensor.rev_counter + self.END_STOP_MARGIN)
         self.valve_sensor.rev_counter = 0
-        print('rev counter: %s' % self.valve_sensor.rev_counter)
-        time.sleep_ms(500)
-        print('moving to opposite end of travel')
-        self.close_valve()
-        self.valve_moving(self.STALL_TIME)
+        self.revs_since_calibration = 0
+        if __debug__:
+            log.debug('valve', 'rev counter: %s', self.valve_sensor.rev_counter)
+        log.info('valve', 'moving to opposite end of travel')
+        if self.closed_position > 0:
+            travel = self.closed_position + 2 * self.END_STOP_MARGIN
+            closed_margin = self.seek_end_stop(1, travel, int(travel * self.drift_rate))
+        else:
+            self.close_valve()
+            self.valve_moving(self.STALL_TIME)
         if self.valve_sensor.rev_counter > 200:
-            self.closed_position = self.valve_sensor.rev_counter - 100
-            self.valve_sensor.rev_counter -= 50
-            self.trv.on_off_attributes['OnOff'] = False
-            print('closed position: %s (rev counter: %s)' % (self.closed_position, self.valve_sensor.rev_counter))
-            self.position = self.closed_position
+            self.closed_position = self.valve_sensor.rev_counter - 2 * self.END_STOP_MARGIN
+            self.valve_sensor.rev_counter -= self.END_STOP_MARGIN
+            log.info('valve', 'closed position: %s (rev counter: %s)', self.closed_position, self.valve_sensor.rev_counter)
+            self.homing_time = time.ticks_diff(time.ticks_ms(), started)
+            self.homing_margin = (open_margin, closed_margin)
+            log.info('valve', 'homed in %i ms, end-stop margins: open %i, closed %i revs', self.homing_time,
+                     open_margin, closed_margin)
+            if rehoming:
+                # a re-home (drift, a missed end-stop or the 'H' command) goes back to the target and on/off state
+                # it found, only homing after a reset leaves the valve closed
+                self.position = self.closed_position if target_closed else min(self.position, self.closed_position)
+            else:
+                self.trv.on_off_attributes['OnOff'] = False
+                self.position = self.closed_position
             self.homing_complete = True
-            time.sleep(10)  # to allow time to process coordinator messages
+            if not rehoming:
+                time.sleep(10)  # to allow time to process coordinator messages
             self.goto_revs()
             # print('rev counter: %s\n' % self.valve_sensor.rev_counter)
         else:
-            print('insufficient valve travel, revs: %i' % self.valve_sensor.rev_counter)
+            log.error('valve', 'insufficient valve travel, revs: %i', self.valve_sensor.rev_counter)
+
+    def seek_end_stop(self, direction, distance, uncertainty):
+        # Drives towards the end-stop expected distance revolutions away: at full speed until it is within
+        # APPROACH_REVS + uncertainty, then slowly until the motor stalls. Returns the revolutions travelled slowly,
+        # negative if the end-stop was met at full speed (by that many revolutions short of the slow approach).
+        sensor = self.valve_sensor
+        fast_revs = max(distance - self.APPROACH_REVS - uncertainty, 0)
+        start = sensor.rev_counter
+        period_filtered = sensor.period_filtered
+        if direction < 0:
+            self.open_valve()
+        else:
+            self.close_valve()
+        timer = time.ticks_ms()
+        slow_from = None
+        last_count = start
+        last_edge = now = timer
+        slow_edges = 0
+        travelled = 0
+        while not self.interupt:
+            sensor.read()
+            now = time.ticks_ms()
+            travelled = abs(sensor.rev_counter - start)
+            if slow_from is None:
+                if travelled >= fast_revs:
+                    # the slow revolutions would drag the filtered period the travel stall detection uses
+                    period_filtered = sensor.period_filtered
+                    self.motor.set_slow(True)
+                    slow_from = travelled
+                    last_count = sensor.rev_counter
+                    last_edge = now
+                elif sensor.period >= 2 * sensor.peek_period:
+                    break
+                elif (travelled == 0) and (time.ticks_diff(now, timer) > 3000):
+                    log.error('valve', 'motor fault')
+                    break
+                continue
+            if sensor.rev_counter != last_count:
+                last_count = sensor.rev_counter
+                if slow_edges:
+                    # the first slow revolution is left out, the motor is still slowing down
+                    period = time.ticks_diff(now, last_edge)
+                    self.slow_period = period if not self.slow_period else (
+                            self.slow_period + (period - self.slow_period) // 4)
+                slow_edges += 1
+                last_edge = now
+            if self.slow_period:
+                stall = max(int(self.SLOW_STALL_FACTOR * self.slow_period), self.SLOW_STALL_MIN)
+            else:
+                stall = self.SLOW_FIRST_STALL
+            # timed from the last edge, or from the switch to slow speed, so a motor that doesn't turn at all stops too
+            if time.ticks_diff(now, last_edge) >= stall:
+                break
+        self.stop_valve()
+        self.motor.set_slow(False)
+        if slow_from is None:
+            energy.stall(max(sensor.period - sensor.peek_period, 0))
+            margin = travelled - fast_revs
+            log.warning('valve', 'end-stop met at full speed, %i revs early', -margin)
+        else:
+            # at the slow duty the motor draws only part of the stall current, counted as that much full stall time
+            energy.stall(max(time.ticks_diff(now, last_edge) - self.slow_period, 0)
+                         * (1023 - self.motor.SLOW_DUTY) // 1023)
+            margin = travelled - slow_from
+        sensor.period_filtered = period_filtered
+        sensor.reset()
+        self.interupt = False
+        sensor.peek_period = sensor.period_filtered // 1
+        self.trv.report_attribute(0x000d, 0x02)
+        return margin
 
     def valve_moving(self, max_period):
         timer = time.ticks_ms()
@@ -168,55 +410,209 @@ class Valve:
         while (self.valve_sensor.period < (2*self.valve_sensor.peek_period)) & (not self.interupt):
             self.valve_sensor.read()
             if (time.ticks_diff(time.ticks_ms(), timer) > 3000) and (self.valve_sensor.rev_counter == 0):
-                print('motor fault')
+                log.error('valve', 'motor fault')
                 #self.trv.send_broadcast_digi_data('motor fault')
                 break
             # self.trv.process_msg()  # do not interupt homing
         self.stop_valve()
+        # driven against the end-stop for as long as the last revolution overran
+        energy.stall(max(self.valve_sensor.period - self.valve_sensor.peek_period, 0))
         self.trv.report_attribute(0x000d, 0x02)
         self.valve_sensor.reset()
         self.interupt = False
         self.valve_sensor.peek_period = self.valve_sensor.period_filtered // 1
-        print('peek period: %s' % self.valve_sensor.peek_period)
+        if __debug__:
+            log.debug('valve', 'peek period: %s', self.valve_sensor.peek_period)
 
     def goto_revs(self):
         if not self.trv.connected_to_HA:
-            print('not yet synchronised with HA')
+            log.warning('valve', 'not yet synchronised with HA')
             return
         if not self.homing_complete:
-            print('still need to home')
+            log.warning('valve', 'still need to home')
             return
         if self.travelling:
             return
+        self.travelling = True
+        self.take_pending_position()
+        self.travel()
+        # a target that arrived too late to re-plan the last move (e.g. once the valve stopped) is started now
+        while self.pending_position is not None:
+            self.take_pending_position()
+            self.travel()
+        if (self.position == 0) and (self.drift() > self.SEEK_DRIFT):
+            self.seek_open_end_stop()
+        self.travelling = False
+
+    def seek_open_end_stop(self):
+        # opens on past the travel, slowly for the last revolutions, until the end-stop stops the motor, which
+        # re-zeroes the counter, then back to 0
+        log.info('valve', 'seeking open end-stop, estimated drift: %i revs', self.drift())
+        margin = self.seek_end_stop(-1, self.valve_sensor.rev_counter + self.END_STOP_MARGIN, int(self.drift()))
+        self.end_stop_contact(-1, margin)
+        self.position = 0
+        self.travel()
+
+    def take_pending_position(self):
+        if self.pending_position is not None:
+            self.position = self.pending_position
+            self.pending_position = None
+
+    def travel(self):
         if self.valve_sensor.rev_counter == self.position:
-            print('valve already at desired position')
+            log.info('valve', 'valve already at desired position')
         else:
-            self.travelling = True
-            print('travelling (rev counter: %s)' % self.valve_sensor.rev_counter)
-            while ((self.valve_sensor.rev_counter is not self.position) & (self.valve_sensor.period < (3*self.valve_sensor.peek_period))) or self.trv.processing_message: #(self.valve_sensor.period < self.STALL_TIME):
+            log.info('valve', 'travelling (rev counter: %s)', self.valve_sensor.rev_counter)
+            self.battery_mV = self.trv.battery_voltage_mV()
+            planned_at = self.valve_sensor.rev_counter
+            self.last_radio_poll = time.ticks_ms()
+            last_sample = self.last_radio_poll
+            longest_gap = 0
+            stall_period = 3 * self.valve_sensor.peek_period
+            next_progress = self.last_radio_poll  # the expected duration goes out in the first radio slot
+            # the current run in one direction, that the travel rate is learned from
+            run_direction = 0
+            run_started = 0
+            run_from = self.valve_sensor.rev_counter
+            expected = 0
+            travelled = 0
+            while ((self.valve_sensor.rev_counter != self.position) & (self.valve_sensor.period < stall_period)) or self.trv.processing_message: #(self.valve_sensor.period < self.STALL_TIME):
                 if self.trv.processing_message:
                     self.trv.processing_message = False
                     self.valve_sensor.reset()
+                # only re-plan every few revolutions, so a burst of commands can't keep reversing the motor
+                if (self.pending_position is not None) and (abs(self.valve_sensor.rev_counter - planned_at) >= self.REPLAN_REVS):
+                    self.take_pending_position()
+                    planned_at = self.valve_sensor.rev_counter
+                    next_progress = time.ticks_ms()
                 if self.valve_sensor.rev_counter > self.position:
-                    self.open_valve()
+                    started = self.open_valve()
                 else:
-                    self.close_valve()
+                    started = self.close_valve()
+                if started:
+                    travelled += abs(self.valve_sensor.rev_counter - run_from)
+                    run_direction = started
+                    run_started = time.ticks_ms()
+                    run_from = self.valve_sensor.rev_counter
+                    expected = self.rate.duration(self.position - run_from, run_direction, self.battery_mV)
+                    stall_period = self.stall_period(run_direction)
                 self.valve_sensor.read()
-                self.trv.process_msg()
+                now = time.ticks_ms()
+                longest_gap = max(longest_gap, time.ticks_diff(now, last_sample))
+                last_sample = now
+                if self.radio_slot(now):
+                    self.last_radio_poll = now
+                    self.trv.process_msg()
+                    if time.ticks_diff(now, next_progress) >= 0:
+                        next_progress = time.ticks_add(now, self.PROGRESS_INTERVAL)
+                        self.report_progress(run_direction)
             self.stop_valve()
-            if self.valve_sensor.period > (3*self.valve_sensor.peek_period):
-                print('\nvalve stalling, period (ms): %i' % self.valve_sensor.period)
+            self.eta = 0
+            self.revs_since_calibration += travelled + abs(self.valve_sensor.rev_counter - run_from)
+            if self.valve_sensor.period >= stall_period:
+                log.warning('valve', 'valve stalling, period (ms): %i', self.valve_sensor.period)
+                energy.stall(self.valve_sensor.period - self.valve_sensor.peek_period)
+                self.end_stop_contact(run_direction)
             else:
-                print('\nvalve reached desired position')
-            print('rev counter: %s' % self.valve_sensor.rev_counter)
-            print('period: %s' % self.valve_sensor.period)
-            print('peek period: %s' % self.valve_sensor.peek_period)
-            print('filtered period: %s' % self.valve_sensor.period_filtered)
+                log.info('valve', 'valve reached desired position')
+                took = time.ticks_diff(time.ticks_ms(), run_started)
+                revs = self.valve_sensor.rev_counter - run_from
+                if (abs(revs) >= self.rate.MIN_REVS) and (took > 0):
+                    self.last_move_speed = (self.rate.duration(revs, run_direction, self.battery_mV) * 100) // took
+                    if took * 100 > expected * self.SLOW_MOVE:
+                        log.warning('valve', 'slow move: %i ms, expected %i ms', took, expected)
+                self.rate.learn(run_direction, self.battery_mV, revs, took)
+            log.info('valve', 'rev counter: %s', self.valve_sensor.rev_counter)
+            if __debug__:
+                log.debug('valve', 'period: %s', self.valve_sensor.period)
+                log.debug('valve', 'peek period: %s', self.valve_sensor.peek_period)
+                log.debug('valve', 'filtered period: %s', self.valve_sensor.period_filtered)
+                log.debug('valve', 'longest sample gap (ms): %s', longest_gap)
             self.trv.report_attribute(0x000d, 0x55)
             self.trv.report_attribute(0x000d, 0x02)
+            self.trv.report_attribute(0x000d, 0x04)
             self.valve_sensor.reset()
             self.valve_sensor.peek_period = self.valve_sensor.period_filtered // 1
-        self.travelling = False
+
+    def end_stop_contact(self, direction, margin=None):
+        # An opening stall close to where the open end-stop is expected is contact with it, which only the seek in
+        # seek_open_end_stop travels far enough to make. The open end-stop is the counter's reference, so contact
+        # with it re-zeroes the counter. margin is the seek's result (see seek_end_stop) when the stall ended one.
+        if direction >= 0:
+            return  # a closing move stops short of the closed end-stop, so this is e.g. a sticking valve
+        drift = self.valve_sensor.rev_counter + self.END_STOP_MARGIN
+        if abs(drift) > self.END_STOP_WINDOW:
+            if (self.valve_sensor.rev_counter < 0) or (margin is not None):
+                # stalled inside the open margin, or a seek (which only ends at a stall) stopped, too far from the
+                # expected end-stop
+                log.warning('valve', 'open end-stop not found, drift: %i revs', drift)
+                self.home_due = True
+            return  # otherwise stalled away from the end-stops, e.g. a sticking valve
+        if margin is not None:
+            log.info('valve', 'end-stop seek, slow approach: %i revs', margin)
+        log.info('valve', 'end-stop contact, drift: %i revs', drift)
+        self.learn_drift(drift)
+        self.valve_sensor.rev_counter = -self.END_STOP_MARGIN
+        self.revs_since_calibration = 0
+
+    def learn_drift(self, drift):
+        self.drift_rate += 0.25 * (abs(drift) / max(self.revs_since_calibration, 1) - self.drift_rate)
+
+    def drift(self):
+        # revolutions the counter may have drifted since it was last corrected
+        return self.revs_since_calibration * self.drift_rate
+
+    def calibration_confidence(self):
+        return max(100 - int(self.drift() * 100 / self.MAX_DRIFT), 0)
+
+    def update(self):
+        # called from the main loop
+        if (not self.home_due) and self.homing_complete and (self.drift() > self.MAX_DRIFT):
+            log.info('valve', 'full home due, estimated drift: %i revs', self.drift())
+            self.home_due = True
+        if self.home_due and not self.travelling:
+            self.home_due = False
+            self.home_valve()
+        if (self.pending_position is not None) and not self.travelling:
+            position = self.pending_position
+            self.pending_position = None
+            self.request_position(position)
+
+    def stall_period(self, direction):
+        # a revolution overrunning this long is a stall: from the learned travel rate once there is one, so a slow
+        # but turning motor (e.g. on a low battery) isn't stopped and a stall on a fast one is caught sooner
+        if self.rate.learned(direction):
+            return self.rate.stall_period(direction, self.battery_mV)
+        return 3 * self.valve_sensor.peek_period
+
+    def report_progress(self, direction):
+        self.eta = self.rate.duration(self.position - self.valve_sensor.rev_counter, direction, self.battery_mV)
+        self.trv.report_attribute(0x000d, 0x55)
+        self.trv.report_attribute(0x000d, 0x04)
+
+    def radio_slot(self, now):
+        # sensor sampling runs flat out while travelling and the radio is only polled in its own slots: at most every
+        # RADIO_POLL_INTERVAL, and only early in a revolution so a frame can be handled before the next sensor edge is
+        # due. Anything else stays queued in the XBee, unless the radio has been deferred for RADIO_MAX_DEFER.
+        since_poll = time.ticks_diff(now, self.last_radio_poll)
+        if since_poll < self.RADIO_POLL_INTERVAL:
+            return False
+        if since_poll >= self.RADIO_MAX_DEFER:
+            return True
+        return self.valve_sensor.timer.set and (
+                self.valve_sensor.period + self.RADIO_SLICE < self.valve_sensor.peek_period // 2)
+
+    def percentage_open(self):
+        if self.closed_position <= 0:
+            return 100
+        percentage = 100 - (self.valve_sensor.rev_counter * 100) // self.closed_position
+        return min(max(percentage, 0), 100)
+
+    def position_for_percentage(self, percentage):
+        return self.closed_position - (self.closed_position * percentage) // 100
+
+    def set_percentage_open(self, percentage):
+        self.request_position(self.position_for_percentage(percentage))
 
     def set_revs(self, rev_no):
         self.valve_sensor.rev_counter = rev_no
@@ -225,11 +621,11 @@ class Valve:
         return self.valve_sensor.period
 
     def count_revs_to_endstop(self):
-        print('counting revs to end of travel')
+        log.info('valve', 'counting revs to end of travel')
         self.open_valve()
         self.valve_moving(3000)
         counter = self.valve_sensor.rev_counter
-        print("rev count at endstop: %i" % counter)
+        log.info('valve', 'rev count at endstop: %i', counter)
         self.position = 0
         self.goto_revs()
         return counter